@@ -5,13 +5,25 @@
 """
 
 __version__ = "0.1.0"
-__all__ = ["AppEngineException", "InputDevice", "Screen", "Sprite", "Manager"]
+__all__ = [
+    "AppEngineException",
+    "InputDevice",
+    "Screen",
+    "Sprite",
+    "Manager",
+    "sprite_aabb_overlap",
+]
 
 import gc
-from time import ticks_us, ticks_diff
+import micropython
+from heapq import heappush, heappop
+from time import ticks_us, ticks_diff, sleep_us
 import uasyncio as asyncio
 
 US_PER_S = 1000000
+US_PER_MS = 1000
+SLEEP_THRESHOLD_US = 500
+SLEEP_MARGIN_US = 200
 STR_NEEDS_SUBCLASS = "Needs to be overridden by a subclass."
 
 
@@ -20,43 +32,113 @@ class AppEngineException(Exception):
 
 
 class InputDevice:
+    poll_ms = 0
+
     def __init__(self):
         pass
 
+    def poll(self):
+        pass
+
     def update(self):
         raise AppEngineException(STR_NEEDS_SUBCLASS)
 
 
 class Screen:
+    partial_clear = False
+    _cam_dx = 0
+    _cam_dy = 0
+    _dirty_rects = None
+    _dirty_all = True
+
     def __init__(self):
         self.display = None
         self.w = 0
         self.h = 0
         self.camera_target = None
 
+    @micropython.native
+    def _begin_frame(self):
+        dirty_rects = self._dirty_rects
+        if dirty_rects is None:
+            dirty_rects = self._dirty_rects = []
+        partial_clear = self.partial_clear
+        full = self._dirty_all or not partial_clear
+        if not full:
+            area = 0
+            for i in range(2, len(dirty_rects), 4):
+                area += dirty_rects[i] * dirty_rects[i + 1]
+            full = area >= self.w * self.h
+        if full:
+            self.display.fill(0)
+        else:
+            fill_rect = self.display.fill_rect
+            for i in range(0, len(dirty_rects), 4):
+                fill_rect(
+                    dirty_rects[i],
+                    dirty_rects[i + 1],
+                    dirty_rects[i + 2],
+                    dirty_rects[i + 3],
+                    0,
+                )
+        del dirty_rects[:]
+        self._dirty_all = not partial_clear
+        self._update_camera_cache()
+
+    def _update_camera_cache(self, _int=int):
+        if self.camera_target:
+            ct = self.camera_target
+            dx = ct.x + (ct.w - self.w) / 2
+            dy = ct.y + (ct.h - self.h) / 2
+            self._cam_dx = _int(dx) if dx == _int(dx) else dx
+            self._cam_dy = _int(dy) if dy == _int(dy) else dy
+        else:
+            self._cam_dx = 0
+            self._cam_dy = 0
+
     def clear(self):
         self.display.fill(0)
         self.update()
 
-    def blit(self, sprite):
+    def blit(self, sprite, _int=int):
         img = sprite._get_img()
         if img:
             x = sprite.x
             y = sprite.y
             if self.camera_target and not sprite.is_overlay:
-                ct = self.camera_target
-                x -= ct.x + (ct.w - self.w) / 2
-                y -= ct.y + (ct.h - self.h) / 2
-            self.display.blit(img, int(x), int(y), sprite.colourkey)
+                x -= self._cam_dx
+                y -= self._cam_dy
+            w = sprite.w
+            h = sprite.h
+            if w and h and (x + w <= 0 or y + h <= 0 or x >= self.w or y >= self.h):
+                return
+            x = _int(x)
+            y = _int(y)
+            self.display.blit(img, x, y, sprite.colourkey)
+            if self.partial_clear:
+                if w and h:
+                    dirty_rects = self._dirty_rects
+                    if dirty_rects is None:
+                        dirty_rects = self._dirty_rects = []
+                    dirty_rects.append(x)
+                    dirty_rects.append(y)
+                    dirty_rects.append(w)
+                    dirty_rects.append(h)
+                else:
+                    self._dirty_all = True
 
     def flip(self):
         self.update()
-        self.display.fill(0)
 
     def update(self):
         raise AppEngineException(STR_NEEDS_SUBCLASS)
 
 
+@micropython.native
+def sprite_aabb_overlap(ax, ay, aw, ah, bx, by, bw, bh):
+    return ax < bx + bw and ax + aw > bx and ay < by + bh and ay + ah > by
+
+
 class Sprite:
     UP, LEFT, DOWN, RIGHT = tuple(range(1, 5))
 
@@ -78,30 +160,40 @@ class Sprite:
         self._layer = 0
         self.manager = None
         self.name = ""
-        self.killed = False
+        self._killed = False
         self._frames_to_kill = None
+        self._kill_frame = None
 
+    @micropython.native
     def _frame_routine(self):
-        self.x += self.vx
-        self.y += self.vy
-        if self._frames_to_kill is not None:
-            self._frames_to_kill -= 1
-            if self._frames_to_kill <= 0:
-                self.killed = True
+        vx = self.vx
+        if vx:
+            self.x += vx
+        vy = self.vy
+        if vy:
+            self.y += vy
         self.update()
 
+    @micropython.native
     def _get_img(self):
-        if not self.imgs:
+        imgs = self.imgs
+        if not imgs:
             return None
-        self.img_idx = (
-            (self.img_idx - self._img_start) % self._img_len + self._img_start
-            if self._img_len
-            else self._img_start
-        )
-        current_img = self.imgs[self.img_idx]
-        self.img_fpstep_counter = (self.img_fpstep_counter + 1) % self._img_fpstep
-        if self.img_fpstep_counter == 0:
-            self.img_idx += 1
+        if self._img_len <= 1:
+            img_start = self._img_start
+            if self.img_idx != img_start:
+                self.img_idx = img_start
+            return imgs[img_start]
+        img_idx = self.img_idx
+        current_img = imgs[img_idx]
+        counter = self.img_fpstep_counter - 1
+        if counter <= 0:
+            counter = self._img_fpstep
+            img_idx += 1
+            if img_idx >= self._img_start + self._img_len:
+                img_idx = self._img_start
+            self.img_idx = img_idx
+        self.img_fpstep_counter = counter
         return current_img
 
     def get_layer(self):
@@ -110,12 +202,20 @@ class Sprite:
     def set_layer(self, layer):
         self._layer = layer
         if self.manager:
-            self.manager._sort_sprites_by_layer()
+            self.manager._layers_dirty = True
 
     def setup_animation(self, start, length, fpstep):
+        if (
+            start == self._img_start
+            and length == self._img_len
+            and fpstep == self._img_fpstep
+        ):
+            return
         self._img_start = start
         self._img_len = length
         self._img_fpstep = fpstep
+        self.img_idx = start
+        self.img_fpstep_counter = fpstep
 
     def clamp_position(self, up=None, left=None, down=None, right=None):
         if right is not None and self.x > right - self.w:
@@ -127,6 +227,21 @@ class Sprite:
         if up is not None and self.y < up:
             self.y = up
 
+    @micropython.native
+    def clamp_position_box(self, up, left, down, right):
+        x = self.x
+        if x > right - self.w:
+            x = right - self.w
+        if x < left:
+            x = left
+        self.x = x
+        y = self.y
+        if y > down - self.h:
+            y = down - self.h
+        if y < up:
+            y = up
+        self.y = y
+
     def clamp_velocity(self, vx_min=None, vx_max=None, vy_min=None, vy_max=None):
         if vx_min is not None and self.vx < vx_min:
             self.vx = vx_min
@@ -137,47 +252,57 @@ class Sprite:
         if vy_max is not None and self.vy > vy_max:
             self.vy = vy_max
 
+    @property
+    def killed(self):
+        return self._killed
+
+    @killed.setter
+    def killed(self, killed):
+        self._killed = killed
+        if killed and self.manager:
+            self.manager._any_killed = True
+
     def kill(self):
-        self.killed = True
+        self._killed = True
+        self._kill_frame = None
+        if self.manager:
+            self.manager._any_killed = True
 
     def kill_after_n_frames(self, num):
-        self._frames_to_kill = num
+        if self.manager:
+            self.manager._schedule_kill(self, num)
+        else:
+            self._frames_to_kill = num
 
-    def check_collision(self, other):
+    def check_collision(self, other, _abs=abs):
         if isinstance(other, Sprite) and other is not self:
-            diff_x = self.x + self.w / 2 - (other.x + other.w / 2)
-            diff_y = self.y + self.h / 2 - (other.y + other.h / 2)
-            margin_dx = abs(diff_x) - (self.w + other.w) / 2
-            margin_dy = abs(diff_y) - (self.h + other.h) / 2
-            if margin_dx < 0 and margin_dy < 0:
-                abs_margin_dy = abs(margin_dy)
-                abs_margin_dx = abs(margin_dx)
-                is_at_top_or_bottom = abs_margin_dy <= abs_margin_dx
-                if diff_y >= 0:
-                    if diff_x >= 0:
-                        if is_at_top_or_bottom:
-                            return self.UP, abs_margin_dy
-                        else:
-                            return self.LEFT, abs_margin_dx
-                    elif is_at_top_or_bottom:
-                        return self.UP, abs_margin_dy
-                    else:
-                        return self.RIGHT, abs_margin_dx
-                elif diff_x >= 0:
-                    if is_at_top_or_bottom:
-                        return self.DOWN, abs_margin_dy
-                    else:
-                        return self.LEFT, abs_margin_dx
-                elif is_at_top_or_bottom:
-                    return self.DOWN, abs_margin_dy
-                else:
-                    return self.RIGHT, abs_margin_dx
+            x = self.x
+            y = self.y
+            w = self.w
+            h = self.h
+            ox = other.x
+            oy = other.y
+            ow = other.w
+            oh = other.h
+            if not sprite_aabb_overlap(x, y, w, h, ox, oy, ow, oh):
+                return None
+            diff2_x = x + x + w - (ox + ox + ow)
+            diff2_y = y + y + h - (oy + oy + oh)
+            abs_margin2_dx = w + ow - _abs(diff2_x)
+            abs_margin2_dy = h + oh - _abs(diff2_y)
+            if abs_margin2_dy <= abs_margin2_dx:
+                return (self.UP if diff2_y >= 0 else self.DOWN, abs_margin2_dy / 2)
+            return (self.LEFT if diff2_x >= 0 else self.RIGHT, abs_margin2_dx / 2)
         return None
 
     def update(self):
         pass
 
 
+def _sprite_layer(sprite):
+    return sprite._layer
+
+
 class Manager:
     DEFAULT_TARGET_FPS = 20
 
@@ -185,54 +310,187 @@ class Manager:
         self.input_device = None
         self.screen = None
         self.sprite_list = []
+        self._sprites_by_cls = {}
+        self._sprite_classes = {}
+        self._any_killed = False
+        self._layers_dirty = False
+        self._kill_heap = []
+        self._kill_seq = 0
         self.target_fps = self.DEFAULT_TARGET_FPS
         self.actual_fps = 0
         self._frame_start_time = ticks_us()
+        self._frame_count = 0
+        gc.collect()
+        mem_free = gc.mem_free()
+        gc.threshold(mem_free // 4 + gc.mem_alloc())
+        self.gc_interval = 30
+        self.gc_low_watermark = mem_free // 4
         self.running = True
 
+    def _schedule_kill(self, sprite, num):
+        deadline = self._frame_count + num
+        sprite._kill_frame = deadline
+        self._kill_seq += 1
+        heappush(self._kill_heap, (deadline, self._kill_seq, sprite))
+
+    def _kill_due_sprites(self):
+        kill_heap = self._kill_heap
+        frame_count = self._frame_count
+        while kill_heap and kill_heap[0][0] <= frame_count:
+            deadline, _, sprite = heappop(kill_heap)
+            if sprite._kill_frame == deadline:
+                sprite.kill()
+
     def _remove_killed_sprites(self):
-        self.sprite_list = [sprite for sprite in self.sprite_list if not sprite.killed]
+        if not self._any_killed:
+            return
+        self._any_killed = False
+        self._drop_killed(self.sprite_list)
+        for sprites in self._sprites_by_cls.values():
+            self._drop_killed(sprites)
+
+    @micropython.native
+    def _drop_killed(self, sprites):
+        n = 0
+        for sprite in sprites:
+            if not sprite._killed:
+                sprites[n] = sprite
+                n += 1
+        del sprites[n:]
+
+    def _get_sprite_classes(self, cls):
+        classes = self._sprite_classes.get(cls)
+        if classes is None:
+            classes = [cls]
+            for base in cls.__bases__:
+                if base is not object:
+                    for c in self._get_sprite_classes(base):
+                        if c not in classes:
+                            classes.append(c)
+            self._sprite_classes[cls] = classes
+        return classes
 
     def _sort_sprites_by_layer(self):
-        self.sprite_list.sort(key=lambda x: x.get_layer())
+        if not self._layers_dirty:
+            return
+        self._layers_dirty = False
+        self.sprite_list.sort(key=_sprite_layer)
 
     def _frame_routine(self):
-        if self.input_device:
-            self.input_device.update()
-        for sprite in self.sprite_list:
+        input_device = self.input_device
+        sprite_list = self.sprite_list
+        screen = self.screen
+        frame_count = self._frame_count + 1
+        self._frame_count = frame_count
+        if input_device:
+            input_device.update()
+        if self._kill_heap:
+            self._kill_due_sprites()
+        for sprite in sprite_list:
             sprite._frame_routine()
         self.update()
         self._remove_killed_sprites()
-        if self.screen:
-            for sprite in self.sprite_list:
-                self.screen.blit(sprite)
-            self.screen.flip()
-        gc.collect()
+        self._sort_sprites_by_layer()
+        if screen:
+            screen._begin_frame()
+            blit = screen.blit
+            for sprite in sprite_list:
+                blit(sprite)
+            screen.flip()
+        if (
+            frame_count % self.gc_interval == 0
+            and gc.mem_free() < self.gc_low_watermark
+        ):
+            gc.collect()
 
     def _frame_tick(self):
         end_time = ticks_us()
         duration = ticks_diff(end_time, self._frame_start_time)
-        if duration >= US_PER_S / self.target_fps:
+        if duration >= self._frame_budget_us:
             self.actual_fps = US_PER_S / duration
             self._frame_start_time = end_time
             return True
         return False
 
-    def add_sprite(self, sprite):
-        self.sprite_list.append(sprite)
-        self._sort_sprites_by_layer()
-        sprite.manager = self
+    def _frame_remaining_us(self):
+        return self._frame_budget_us - ticks_diff(ticks_us(), self._frame_start_time)
 
-    def get_sprites(self, cls=Sprite, name=None):
-        return [
-            sprite
-            for sprite in self.sprite_list
-            if isinstance(sprite, cls) and (not name or sprite.name == name)
-        ]
+    async def _input_loop(self):
+        input_device = self.input_device
+        while self.running:
+            input_device.poll()
+            await asyncio.sleep_ms(input_device.poll_ms)
 
-    def kill_sprites(self, cls=Sprite, name=None):
-        for sprite in self.sprite_list:
-            if isinstance(sprite, cls) and (not name or sprite.name == name):
+    async def _render_loop(self):
+        while self.running:
+            await asyncio.sleep(0)
+            self._frame_routine()
+            remaining_ms = self._frame_remaining_us() // US_PER_MS
+            if remaining_ms > 0:
+                await asyncio.sleep_ms(remaining_ms)
+            while not self._frame_tick():
+                await asyncio.sleep(0)
+
+    @property
+    def target_fps(self):
+        return self._target_fps
+
+    @target_fps.setter
+    def target_fps(self, fps):
+        self._target_fps = fps
+        self._frame_budget_us = US_PER_S // fps
+
+    def add_sprite(self, sprite):
+        sprite_list = self.sprite_list
+        if sprite_list and sprite._layer < sprite_list[-1]._layer:
+            self._layers_dirty = True
+        sprite_list.append(sprite)
+        for cls in self._get_sprite_classes(type(sprite)):
+            self._sprites_by_cls.setdefault(cls, []).append(sprite)
+        sprite.manager = self
+        if sprite._killed:
+            self._any_killed = True
+        frames_to_kill = sprite._frames_to_kill
+        if frames_to_kill is not None:
+            sprite._frames_to_kill = None
+            self._schedule_kill(sprite, frames_to_kill)
+
+    def get_sprites(self, cls=Sprite, name=None, exact=False):
+        sprites = self._sprites_by_cls.get(cls)
+        if sprites is None:
+            return []
+        if name or exact:
+            return [
+                sprite
+                for sprite in sprites
+                if (not exact or type(sprite) is cls)
+                and (not name or sprite.name == name)
+            ]
+        return list(sprites)
+
+    @micropython.native
+    def get_colliding_sprites(self, sprite, cls=Sprite):
+        x = sprite.x
+        y = sprite.y
+        right = x + sprite.w
+        bottom = y + sprite.h
+        colliding = []
+        for other in self._sprites_by_cls.get(cls, ()):
+            if other is sprite or other._killed:
+                continue
+            ox = other.x
+            if x < ox + other.w and right > ox:
+                oy = other.y
+                if y < oy + other.h and bottom > oy:
+                    colliding.append(other)
+        return colliding
+
+    def kill_sprites(self, cls=Sprite, name=None, exact=False):
+        sprites = self._sprites_by_cls.get(cls)
+        if sprites is None:
+            return
+        for sprite in sprites:
+            if (not exact or type(sprite) is cls) and (not name or sprite.name == name):
                 sprite.kill()
 
     def exit(self):
@@ -243,17 +501,19 @@ class Manager:
             self.screen.clear()
         while self.running:
             self._frame_routine()
+            remaining = self._frame_remaining_us()
+            if remaining > SLEEP_THRESHOLD_US:
+                sleep_us(remaining - SLEEP_MARGIN_US)
             while not self._frame_tick():
                 pass
 
     async def arun(self):
         if self.screen:
             self.screen.clear()
-        while self.running:
-            await asyncio.sleep(0)
-            self._frame_routine()
-            while not self._frame_tick():
-                await asyncio.sleep(0)
+        if self.input_device and self.input_device.poll_ms > 0:
+            await asyncio.gather(self._input_loop(), self._render_loop())
+        else:
+            await self._render_loop()
 
     def update(self):
         pass
@@ -2,25 +2,26 @@
 This script is for defining macros for MkDocs macros plugin.
 
 The hook function is `define_env`.
-"""
-
-import math
-import csv
-from functools import partial
-from pathlib import Path
 
-from tabulate import tabulate
+It runs on the host when building the docs and is not for MicroPython.
+The imports live inside the functions so nothing is loaded until MkDocs
+calls them.
+"""
 
 
 def define_env(env):
     """Hook function"""
 
+    from functools import partial
+
     env.macro(pi_string)
     env.macro(partial(csv_table, env=env), "csv_table")
     env.macro(youtube)
 
 
 def pi_string(dp=2):
+    import math
+
     fmt = "{:." + str(dp) + "f}"
     return fmt.format(math.pi)
 
@@ -38,6 +39,11 @@ def csv_table(
     colalign=None,
     env=None,
 ):
+    import csv
+    from pathlib import Path
+
+    from tabulate import tabulate
+
     if env is None:
         raise Exception("csv_table env does not exist!")
 
@@ -4,8 +4,8 @@
 - License: MIT
 """
 
-from math import ceil
 import random
+import micropython
 from machine import Pin, I2C, TouchPad
 from framebuf import FrameBuffer, MONO_VLSB
 from ssd1306 import SSD1306_I2C
@@ -13,9 +13,24 @@ from microbmp import MicroBMP
 from appengine import InputDevice, Screen, Sprite, Manager
 
 
+@micropython.viper
+def bmp_from_mono_vlsb(dst: ptr8, src: ptr8, w: int, h: int):
+    # `src` is a MONO_VLSB buffer, one byte for 8 vertical pixels.
+    # `dst` is a cleared 1-bit MicroBMP pixel array, packed row by row, MSB first.
+    for y in range(h):
+        for x in range(w):
+            if (src[x + (y >> 3) * w] >> (y & 7)) & 1:
+                i = y * w + x
+                dst[i >> 3] |= 0x80 >> (i & 7)
+
+
 class GameKeyBoard(InputDevice):
     NUM_OF_KEYS = 6
     BACK, UP, ENTER, LEFT, DOWN, RIGHT = tuple(range(NUM_OF_KEYS))
+    # Masks of the keys in `keys_on`, `keys_off`, etc.
+    M_BACK, M_UP, M_ENTER = 1 << BACK, 1 << UP, 1 << ENTER
+    M_LEFT, M_DOWN, M_RIGHT = 1 << LEFT, 1 << DOWN, 1 << RIGHT
+    M_ALL = (1 << NUM_OF_KEYS) - 1
 
     PIN_BACK = 32
     PIN_UP = 15
@@ -50,24 +65,34 @@ class GameKeyBoard(InputDevice):
             self.THRE_DOWN,
             self.THRE_RIGHT,
         ]
-        self.keys_all = set(range(self.NUM_OF_KEYS))
-
-        self.keys_on = set()
-        self.keys_off = self.keys_all - self.keys_on
-        self.keys_pressed = set()
-        self.keys_released = set()
+        # Key states are bitmasks, bit `i` stands for key `i`.
+        self.keys_on = 0
+        self.keys_off = self.M_ALL
+        self.keys_pressed = 0
+        self.keys_released = 0
 
+    @micropython.native
     def update(self):
-        old_keys_on = self.keys_on
-        old_keys_off = self.keys_off
-
-        self.keys_on = set()
-        for i in range(len(self.keys)):
-            if self.keys[i].read() < self._thresholds[i]:
-                self.keys_on.add(i)
-        self.keys_off = self.keys_all - self.keys_on
-        self.keys_pressed = self.keys_on - old_keys_on
-        self.keys_released = self.keys_off - old_keys_off
+        # Unrolled for the native emitter, bit `i` stands for key `i`.
+        keys = self.keys
+        thresholds = self._thresholds
+        keys_on = 0
+        if keys[0].read() < thresholds[0]:
+            keys_on |= 1
+        if keys[1].read() < thresholds[1]:
+            keys_on |= 2
+        if keys[2].read() < thresholds[2]:
+            keys_on |= 4
+        if keys[3].read() < thresholds[3]:
+            keys_on |= 8
+        if keys[4].read() < thresholds[4]:
+            keys_on |= 16
+        if keys[5].read() < thresholds[5]:
+            keys_on |= 32
+        self.keys_pressed = keys_on & ~self.keys_on
+        self.keys_released = self.keys_on & ~keys_on
+        self.keys_on = keys_on
+        self.keys_off = self.M_ALL ^ keys_on
 
 
 class GameScreen(Screen):
@@ -84,19 +109,19 @@ class GameScreen(Screen):
         self.display = SSD1306_I2C(self.WIDTH, self.HEIGHT, i2c)
         self.w = self.WIDTH
         self.h = self.HEIGHT
+        # Every sprite's size covers its image, so only those areas are cleared.
+        self.partial_clear = True
 
     def print_screen(self, img):
-        for y in range(img.DIB_h):
-            for x in range(img.DIB_w):
-                img[x, y] = self.display.pixel(x, y)
+        bmp_from_mono_vlsb(img.parray, self.display.buffer, img.DIB_w, img.DIB_h)
 
     def update(self):
         self.display.show()
 
         keyboard = self.manager.input_device
         if (
-            GameKeyBoard.ENTER in keyboard.keys_on
-            and GameKeyBoard.BACK in keyboard.keys_released
+            keyboard.keys_on & GameKeyBoard.M_ENTER
+            and keyboard.keys_released & GameKeyBoard.M_BACK
         ):
             print("Printing screen...")
             img_screen = MicroBMP(128, 64, 1)
@@ -110,7 +135,7 @@ class Player(Sprite):
     HEIGHT = 8
 
     FB0 = FrameBuffer(
-        bytearray(WIDTH * ceil(HEIGHT / 8)),
+        bytearray(WIDTH * ((HEIGHT + 7) >> 3)),
         WIDTH,
         HEIGHT,
         MONO_VLSB,
@@ -118,7 +143,7 @@ class Player(Sprite):
     FB0.fill_rect(0, 0, WIDTH, HEIGHT, 1)
 
     FB1 = FrameBuffer(
-        bytearray(WIDTH * ceil(HEIGHT / 8)),
+        bytearray(WIDTH * ((HEIGHT + 7) >> 3)),
         WIDTH,
         HEIGHT,
         MONO_VLSB,
@@ -140,23 +165,23 @@ class Player(Sprite):
         self.name = "player"
 
     def update(self):
-        keyboard = self.manager.input_device
+        keys_on = self.manager.input_device.keys_on
 
-        if GameKeyBoard.UP in keyboard.keys_on:
+        if keys_on & GameKeyBoard.M_UP:
             self.vy = -3
-        elif GameKeyBoard.DOWN in keyboard.keys_on:
+        elif keys_on & GameKeyBoard.M_DOWN:
             self.vy = 3
         else:
             self.vy = 0
 
-        if GameKeyBoard.LEFT in keyboard.keys_on:
+        if keys_on & GameKeyBoard.M_LEFT:
             self.vx = -3
-        elif GameKeyBoard.RIGHT in keyboard.keys_on:
+        elif keys_on & GameKeyBoard.M_RIGHT:
             self.vx = 3
         else:
             self.vx = 0
 
-        self.clamp_position(0, 0, GameScreen.HEIGHT, GameScreen.WIDTH)
+        self.clamp_position_box(0, 0, GameScreen.HEIGHT, GameScreen.WIDTH)
 
 
 class Bean(Sprite):
@@ -164,7 +189,7 @@ class Bean(Sprite):
     HEIGHT = 4
 
     FB0 = FrameBuffer(
-        bytearray(WIDTH * ceil(HEIGHT / 8)),
+        bytearray(WIDTH * ((HEIGHT + 7) >> 3)),
         WIDTH,
         HEIGHT,
         MONO_VLSB,
@@ -188,7 +213,7 @@ class OverlayText(Sprite):
     HEIGHT = 8
 
     FB = FrameBuffer(
-        bytearray(WIDTH * ceil(HEIGHT / 8)),
+        bytearray(WIDTH * ((HEIGHT + 7) >> 3)),
         WIDTH,
         HEIGHT,
         MONO_VLSB,
@@ -205,14 +230,20 @@ class OverlayText(Sprite):
         self.colourkey = 0
         self.is_overlay = True
         self.set_layer(255)
+        self._fps = None
+        self._objs = None
 
     def update(self):
-        self.FB.fill(0)
+        fps = int(self.manager.actual_fps + 0.5)
+        objs = len(self.manager.get_sprites())
+        # Only redraw when a displayed number changes.
+        if fps == self._fps and objs == self._objs:
+            return
+        self._fps = fps
+        self._objs = objs
 
-        fps_objs_text = "FPS:{:3d} OBJs:{:3d}".format(
-            int(self.manager.actual_fps + 0.5),
-            len(self.manager.get_sprites()),
-        )
+        self.FB.fill(0)
+        fps_objs_text = "FPS:{:3d} OBJs:{:3d}".format(fps, objs)
         self.FB.text(fps_objs_text, 0, 0)
 
 
@@ -230,21 +261,19 @@ class GameManager(Manager):
     def update(self):
         keyboard = self.input_device
         if (
-            GameKeyBoard.ENTER not in keyboard.keys_on
-            and GameKeyBoard.BACK in keyboard.keys_released
+            not (keyboard.keys_on & GameKeyBoard.M_ENTER)
+            and keyboard.keys_released & GameKeyBoard.M_BACK
         ):
             print("`Back` is released. Exiting...")
             self.exit()
             return
 
         player = self.get_sprites(name="player")[0]
-        beans = self.get_sprites(cls=Bean)
 
-        for bean in beans:
-            if player.check_collision(bean):
-                bean.kill()
+        for bean in self.get_colliding_sprites(player, Bean):
+            bean.kill()
 
-        if len(beans) < 5:
+        if len(self.get_sprites(cls=Bean)) < 5:
             self.add_sprite(Bean())
 
 
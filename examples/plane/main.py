@@ -4,8 +4,9 @@
 - License: MIT
 """
 
-from math import ceil
+import os
 import random
+import micropython
 from machine import Pin, I2C, TouchPad
 from framebuf import FrameBuffer, MONO_VLSB
 import uasyncio as asyncio
@@ -18,33 +19,101 @@ from appengine import InputDevice, Screen, Sprite, Manager
 IMAGES_DIR = "images/"
 
 
+@micropython.viper
+def mono_vlsb_from_bmp(dst: ptr8, src: ptr8, w: int, h: int):
+    # `src` is a 1-bit MicroBMP pixel array, packed row by row, MSB first.
+    # `dst` is a cleared MONO_VLSB buffer, one byte for 8 vertical pixels.
+    for y in range(h):
+        for x in range(w):
+            i = y * w + x
+            if (src[i >> 3] >> (7 - (i & 7))) & 1:
+                dst[x + (y >> 3) * w] |= 1 << (y & 7)
+
+
+@micropython.viper
+def mono_vlsb_mirror_v(dst: ptr8, src: ptr8, w: int, h: int):
+    # Both `src` and `dst` are MONO_VLSB buffers, `dst` is cleared.
+    if not (h & 7):
+        # Whole pages, reverse the page order and the bits of every byte.
+        pages = h >> 3
+        for p in range(pages):
+            i = p * w
+            j = (pages - p - 1) * w
+            for x in range(w):
+                b = src[i + x]
+                b = ((b & 0xF0) >> 4) | ((b & 0x0F) << 4)
+                b = ((b & 0xCC) >> 2) | ((b & 0x33) << 2)
+                b = ((b & 0xAA) >> 1) | ((b & 0x55) << 1)
+                dst[j + x] = b
+        return
+    for y in range(h):
+        yy = h - y - 1
+        for x in range(w):
+            if (src[x + (y >> 3) * w] >> (y & 7)) & 1:
+                dst[x + (yy >> 3) * w] |= 1 << (yy & 7)
+
+
+@micropython.viper
+def bmp_from_mono_vlsb(dst: ptr8, src: ptr8, w: int, h: int):
+    # `src` is a MONO_VLSB buffer, one byte for 8 vertical pixels.
+    # `dst` is a cleared 1-bit MicroBMP pixel array, packed row by row, MSB first.
+    for y in range(h):
+        for x in range(w):
+            if (src[x + (y >> 3) * w] >> (y & 7)) & 1:
+                i = y * w + x
+                dst[i >> 3] |= 0x80 >> (i & 7)
+
+
 def framebuf_from_img(img_path):
+    # The decoded image is cached next to it as a `.fbuf` file,
+    # a little endian (w, h) header of 2 bytes each followed by the buffer.
+    # It is only trusted when it is not older than the image,
+    # its size is not zero and its length matches the header,
+    # else the image is decoded again.
+    fbuf_path = img_path + ".fbuf"
+    try:
+        fbuf_stat = os.stat(fbuf_path)
+        if fbuf_stat[8] >= os.stat(img_path)[8]:
+            with open(fbuf_path, "rb") as file:
+                header = file.read(4)
+                w = header[0] | header[1] << 8
+                h = header[2] | header[3] << 8
+                buf_len = w * ((h + 7) >> 3)
+                if w and h and fbuf_stat[6] == 4 + buf_len:
+                    buf = bytearray(buf_len)
+                    if file.readinto(buf) == buf_len:
+                        return FrameBuffer(buf, w, h, MONO_VLSB)
+    except (OSError, IndexError):
+        pass
+
     img = MicroBMP().load(img_path)
-    fb = FrameBuffer(
-        bytearray(img.DIB_w * ceil(img.DIB_h / 8)),
-        img.DIB_w,
-        img.DIB_h,
-        MONO_VLSB,
-    )
+    w, h = img.DIB_w, img.DIB_h
+    buf = bytearray(w * ((h + 7) >> 3))
+    mono_vlsb_from_bmp(buf, img.parray, w, h)
 
-    for y in range(img.DIB_h):
-        for x in range(img.DIB_w):
-            fb.pixel(x, y, img[x, y])
+    try:
+        with open(fbuf_path, "wb") as file:
+            file.write(bytes((w & 0xFF, w >> 8, h & 0xFF, h >> 8)))
+            file.write(buf)
+    except OSError:
+        pass
 
-    return fb
+    return FrameBuffer(buf, w, h, MONO_VLSB)
 
 
 def mirror_framebuf_v(fb, w, h):
-    new_fb = FrameBuffer(bytearray(w * ceil(h / 8)), w, h, MONO_VLSB)
-    for y in range(h):
-        for x in range(w):
-            new_fb.pixel(x, y, fb.pixel(x, h - y - 1))
-    return new_fb
+    buf = bytearray(w * ((h + 7) >> 3))
+    mono_vlsb_mirror_v(buf, fb, w, h)
+    return FrameBuffer(buf, w, h, MONO_VLSB)
 
 
 class GameKeyBoard(InputDevice):
     NUM_OF_KEYS = 6
     BACK, UP, ENTER, LEFT, DOWN, RIGHT = tuple(range(NUM_OF_KEYS))
+    # Masks of the keys in `keys_on`, `keys_off`, etc.
+    M_BACK, M_UP, M_ENTER = 1 << BACK, 1 << UP, 1 << ENTER
+    M_LEFT, M_DOWN, M_RIGHT = 1 << LEFT, 1 << DOWN, 1 << RIGHT
+    M_ALL = (1 << NUM_OF_KEYS) - 1
 
     PIN_BACK = 32
     PIN_UP = 15
@@ -60,6 +129,8 @@ class GameKeyBoard(InputDevice):
     THRE_DOWN = 590
     THRE_RIGHT = 520
 
+    POLL_MS = 8
+
     def __init__(self):
         super().__init__()
 
@@ -79,24 +150,47 @@ class GameKeyBoard(InputDevice):
             self.THRE_DOWN,
             self.THRE_RIGHT,
         ]
-        self.keys_all = set(range(self.NUM_OF_KEYS))
-
-        self.keys_on = set()
-        self.keys_off = self.keys_all - self.keys_on
-        self.keys_pressed = set()
-        self.keys_released = set()
-
+        # Key states are bitmasks, bit `i` stands for key `i`.
+        self.keys_on = 0
+        self.keys_off = self.M_ALL
+        self.keys_pressed = 0
+        self.keys_released = 0
+
+        # Keys touched between frames, so short touches are not missed.
+        self.poll_ms = self.POLL_MS
+        self._keys_polled = 0
+
+    @micropython.native
+    def _read_keys(self):
+        # Unrolled for the native emitter, bit `i` stands for key `i`.
+        keys = self.keys
+        thresholds = self._thresholds
+        keys_on = 0
+        if keys[0].read() < thresholds[0]:
+            keys_on |= 1
+        if keys[1].read() < thresholds[1]:
+            keys_on |= 2
+        if keys[2].read() < thresholds[2]:
+            keys_on |= 4
+        if keys[3].read() < thresholds[3]:
+            keys_on |= 8
+        if keys[4].read() < thresholds[4]:
+            keys_on |= 16
+        if keys[5].read() < thresholds[5]:
+            keys_on |= 32
+        return keys_on
+
+    def poll(self):
+        self._keys_polled |= self._read_keys()
+
+    @micropython.native
     def update(self):
-        old_keys_on = self.keys_on
-        old_keys_off = self.keys_off
-
-        self.keys_on = set()
-        for i in range(len(self.keys)):
-            if self.keys[i].read() < self._thresholds[i]:
-                self.keys_on.add(i)
-        self.keys_off = self.keys_all - self.keys_on
-        self.keys_pressed = self.keys_on - old_keys_on
-        self.keys_released = self.keys_off - old_keys_off
+        keys_on = self._read_keys() | self._keys_polled
+        self._keys_polled = 0
+        self.keys_pressed = keys_on & ~self.keys_on
+        self.keys_released = self.keys_on & ~keys_on
+        self.keys_on = keys_on
+        self.keys_off = self.M_ALL ^ keys_on
 
 
 class GameScreen(Screen):
@@ -113,19 +207,19 @@ class GameScreen(Screen):
         self.display = SSD1306_I2C(self.WIDTH, self.HEIGHT, i2c)
         self.w = self.WIDTH
         self.h = self.HEIGHT
+        # Every sprite's size covers its image, so only those areas are cleared.
+        self.partial_clear = True
 
     def print_screen(self, img):
-        for y in range(img.DIB_h):
-            for x in range(img.DIB_w):
-                img[x, y] = self.display.pixel(x, y)
+        bmp_from_mono_vlsb(img.parray, self.display.buffer, img.DIB_w, img.DIB_h)
 
     def update(self):
         self.display.show()
 
         keyboard = self.manager.input_device
         if (
-            GameKeyBoard.ENTER in keyboard.keys_on
-            and GameKeyBoard.BACK in keyboard.keys_released
+            keyboard.keys_on & GameKeyBoard.M_ENTER
+            and keyboard.keys_released & GameKeyBoard.M_BACK
         ):
             print("Printing screen...")
             img_screen = MicroBMP(128, 64, 1)
@@ -139,6 +233,7 @@ class Player(Sprite):
 
     WIDTH = 8
     HEIGHT = 8
+    MAX_V2 = 6
 
     FB_IDLE = framebuf_from_img(IMAGES_DIR + "idle.bmp")
     FB_UP = framebuf_from_img(IMAGES_DIR + "up.bmp")
@@ -152,6 +247,10 @@ class Player(Sprite):
         self.y = GameScreen.HEIGHT // 2
         self.w = self.WIDTH
         self.h = self.HEIGHT
+        self._x2 = self.x << 1
+        self._y2 = self.y << 1
+        self._vx2 = 0
+        self._vy2 = 0
         self.imgs = [
             self.FB_IDLE,
             self.FB_UP,
@@ -172,30 +271,46 @@ class Player(Sprite):
         elif self.state == self.STATE_DEAD:
             self.setup_animation(3, 1, 1)
 
+    @staticmethod
+    def _halve(v2):
+        # Halve a velocity, rounding towards zero so it settles at 0.
+        return -(-v2 >> 1) if v2 < 0 else v2 >> 1
+
     def update(self):
+        # Position and velocity are kept as ints in half pixels,
+        # `vx` and `vy` stay 0 so the engine does not move the player.
+        x2 = self._x2 + self._vx2
+        y2 = self._y2 + self._vy2
+
         if self.state != self.STATE_DEAD:
-            if GameKeyBoard.UP in self.manager.input_device.keys_on:
+            keys_on = self.manager.input_device.keys_on
+            if keys_on & GameKeyBoard.M_UP:
                 self.set_state(self.STATE_UP)
-                self.vy -= 0.5
-            elif GameKeyBoard.DOWN in self.manager.input_device.keys_on:
+                vy2 = self._vy2 - 1
+            elif keys_on & GameKeyBoard.M_DOWN:
                 self.set_state(self.STATE_DOWN)
-                self.vy += 0.5
+                vy2 = self._vy2 + 1
             else:
                 self.set_state(self.STATE_IDLE)
-                self.vy /= 2
+                vy2 = self._halve(self._vy2)
 
-            if GameKeyBoard.LEFT in self.manager.input_device.keys_on:
-                self.vx -= 0.5
-            elif GameKeyBoard.RIGHT in self.manager.input_device.keys_on:
-                self.vx += 0.5
+            if keys_on & GameKeyBoard.M_LEFT:
+                vx2 = self._vx2 - 1
+            elif keys_on & GameKeyBoard.M_RIGHT:
+                vx2 = self._vx2 + 1
             else:
-                self.vx /= 2
+                vx2 = self._halve(self._vx2)
+
+            self._vx2 = min(max(vx2, -self.MAX_V2), self.MAX_V2)
+            self._vy2 = min(max(vy2, -self.MAX_V2), self.MAX_V2)
         else:
-            self.vy = 0
-            self.vx = 0
+            self._vx2 = 0
+            self._vy2 = 0
 
-        self.clamp_velocity(-3, 3, -3, 3)
-        self.clamp_position(0, 0, GameScreen.HEIGHT, GameScreen.WIDTH)
+        self._x2 = min(max(x2, 0), (GameScreen.WIDTH - self.w) << 1)
+        self._y2 = min(max(y2, 0), (GameScreen.HEIGHT - self.h) << 1)
+        self.x = self._x2 >> 1
+        self.y = self._y2 >> 1
 
 
 class Missile(Sprite):
@@ -203,7 +318,7 @@ class Missile(Sprite):
     HEIGHT = 2
 
     FB = FrameBuffer(
-        bytearray(WIDTH * ceil(HEIGHT / 8)),
+        bytearray(WIDTH * ((HEIGHT + 7) >> 3)),
         WIDTH,
         HEIGHT,
         MONO_VLSB,
@@ -218,10 +333,15 @@ class Missile(Sprite):
         self.w = self.WIDTH
         self.h = self.HEIGHT
 
-        self.vx = random.uniform(-4, -1)
+        # Position and velocity are kept as ints in 1/256 pixels,
+        # `vx` stays 0 so the engine does not move the missile.
+        self._x8 = self.x << 8
+        self._vx8 = -random.randrange(1 << 8, (4 << 8) + 1)
         self.imgs = [self.FB]
 
     def update(self):
+        self._x8 += self._vx8
+        self.x = self._x8 >> 8
         if self.x < -self.w:
             self.kill()
 
@@ -236,10 +356,15 @@ class Overlay(Sprite):
         self.is_overlay = True
         self.set_layer(255)
 
+        self._text = None
         self._lines = []
         self._has_outline = False
         self._invert = False
 
+        # The frame buffer memory is kept and reused while it is big enough.
+        self._fb_buf = bytearray(0)
+        self._rendered = None
+
     def set_text(
         self,
         text=None,
@@ -248,7 +373,18 @@ class Overlay(Sprite):
         has_outline=None,
         invert=None,
     ):
+        if (
+            text == self._text
+            and anchor_h is None
+            and anchor_v is None
+            and (has_outline is None or has_outline == self._has_outline)
+            and (invert is None or invert == self._invert)
+        ):
+            # Nothing changes.
+            return
+
         if text is not None:
+            self._text = text
             self._lines = text.splitlines()
 
         if has_outline is not None:
@@ -268,23 +404,26 @@ class Overlay(Sprite):
         if anchor_h == self.H_LEFT:
             self.x = 0
         elif anchor_h == self.H_CENTER:
-            self.x = (GameScreen.WIDTH - self.w) / 2
+            self.x = (GameScreen.WIDTH - self.w) // 2
         elif anchor_h == self.H_CENTER:
             self.x = GameScreen.WIDTH - self.w
 
         if anchor_v == self.V_TOP:
             self.y = 0
         elif anchor_v == self.V_CENTER:
-            self.y = (GameScreen.HEIGHT - self.h) / 2
+            self.y = (GameScreen.HEIGHT - self.h) // 2
         elif anchor_v == self.V_BOTTOM:
             self.y = GameScreen.HEIGHT - self.h
 
-        fb = FrameBuffer(
-            bytearray(self.w * ceil(self.h / 8)),
-            self.w,
-            self.h,
-            MONO_VLSB,
-        )
+        rendered = (self._lines, self._has_outline, self._invert)
+        if rendered == self._rendered:
+            return
+        self._rendered = rendered
+
+        buf_len = self.w * ((self.h + 7) >> 3)
+        if len(self._fb_buf) < buf_len:
+            self._fb_buf = bytearray(buf_len)
+        fb = FrameBuffer(self._fb_buf, self.w, self.h, MONO_VLSB)
 
         fb.fill(1 if self._invert else 0)
         if self._has_outline:
@@ -299,22 +438,31 @@ class Overlay(Sprite):
 class PopUp(Overlay):
     WIDTH = 15
 
+    # Button rows by buttons, shared by all pop-ups.
+    _btn_texts = {}
+
     def __init__(self, name="", text="", buttons=None):
         super().__init__()
 
+        # Above the other overlays, sprites sharing a layer have no fixed order.
+        self.set_layer(256)
         self.name = name
         self._has_outline = True
         self.buttons = buttons or ["OK"]
         self.result = None
 
-        if len(self.buttons) == 1:
-            btn_text = " " * (self.WIDTH - len(self.buttons[0])) + self.buttons[0]
-        else:
-            btn_text = (
-                self.buttons[0]
-                + " " * (self.WIDTH - len(self.buttons[0]) - len(self.buttons[1]))
-                + self.buttons[1]
-            )
+        key = tuple(self.buttons)
+        btn_text = self._btn_texts.get(key)
+        if btn_text is None:
+            if len(self.buttons) == 1:
+                btn_text = " " * (self.WIDTH - len(self.buttons[0])) + self.buttons[0]
+            else:
+                btn_text = (
+                    self.buttons[0]
+                    + " " * (self.WIDTH - len(self.buttons[0]) - len(self.buttons[1]))
+                    + self.buttons[1]
+                )
+            self._btn_texts[key] = btn_text
 
         self.set_text(
             text + "\n" + btn_text,
@@ -327,15 +475,15 @@ class PopUp(Overlay):
     def update(self):
         keyboard = self.manager.input_device
         if len(self.buttons) == 1:
-            if GameKeyBoard.ENTER in keyboard.keys_released:
+            if keyboard.keys_released & GameKeyBoard.M_ENTER:
                 self.result = self.buttons[0]
         else:
             if (
-                GameKeyBoard.ENTER not in keyboard.keys_on
-                and GameKeyBoard.BACK in keyboard.keys_released
+                not (keyboard.keys_on & GameKeyBoard.M_ENTER)
+                and keyboard.keys_released & GameKeyBoard.M_BACK
             ):
                 self.result = self.buttons[0]
-            if GameKeyBoard.ENTER in keyboard.keys_released:
+            if keyboard.keys_released & GameKeyBoard.M_ENTER:
                 self.result = self.buttons[1]
 
 
@@ -344,15 +492,14 @@ class TopLabel(Overlay):
         super().__init__()
 
         self.colourkey = 0
+        self._tenths = None
 
     def update(self):
-        fps_objs_text = "FPS:{:3d} OBJs:{:3d}".format(
-            int(self.manager.actual_fps + 0.5),
-            len(self.manager.get_sprites()),
-        )
-        time_text = "Time: {:.1f}s".format(self.manager.time_elapsed / 1000)
-        # self.set_text(fps_objs_text)
-        self.set_text(time_text)
+        # The label shows tenths of a second, it is only formatted when they change.
+        tenths = self.manager.time_elapsed // 100
+        if tenths != self._tenths:
+            self._tenths = tenths
+            self.set_text("Time: {}.{}s".format(tenths // 10, tenths % 10))
 
 
 class GameManager(Manager):
@@ -379,15 +526,16 @@ class GameManager(Manager):
             self.set_missile_spawn_interval(random.randrange(5, 10))
 
     def check_collisions(self):
-        for m in self.get_sprites(cls=Missile):
-            if self.player.check_collision(m):
-                m.kill()
-                self.player.set_state(Player.STATE_DEAD)
-                break
-
-        if self.player.state == Player.STATE_DEAD:
+        player = self.player
+        # Only a hit matters here, the side of contact is not needed.
+        hits = self.get_colliding_sprites(player, Missile)
+        if hits:
+            hits[0].kill()
+            player.set_state(Player.STATE_DEAD)
+
+        if player.state == Player.STATE_DEAD:
             for m in self.get_sprites(cls=Missile):
-                m.vx = 0
+                m._vx8 = 0
 
     def get_popup_result(self, k):
         v = self._popup_result.get(k)
@@ -432,8 +580,8 @@ class GameManager(Manager):
         if self.player.state == Player.STATE_DEAD:
             keyboard = self.input_device
             if (
-                GameKeyBoard.ENTER not in keyboard.keys_on
-                and GameKeyBoard.BACK in keyboard.keys_released
+                not (keyboard.keys_on & GameKeyBoard.M_ENTER)
+                and keyboard.keys_released & GameKeyBoard.M_BACK
             ):
                 self.popup("Restart", "Restart?\n", ["NO", "YES"])
                 return
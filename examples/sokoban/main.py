@@ -5,8 +5,7 @@
 """
 
 import os
-from math import ceil
-from collections import namedtuple
+import micropython
 import uasyncio as asyncio
 from machine import Pin, I2C, TouchPad, freq
 from framebuf import FrameBuffer, MONO_VLSB
@@ -18,36 +17,97 @@ from appengine import InputDevice, Screen, Sprite, Manager
 IMAGES_DIR = "images/"
 LEVELS_DIR = "levels/"
 
-Point = namedtuple("Point", ("x", "y"))
+
+@micropython.viper
+def bmp_from_mono_vlsb(dst: ptr8, src: ptr8, w: int, h: int):
+    # `src` is a MONO_VLSB buffer, one byte for 8 vertical pixels.
+    # `dst` is a cleared 1-bit MicroBMP pixel array, packed row by row, MSB first.
+    for y in range(h):
+        for x in range(w):
+            if (src[x + (y >> 3) * w] >> (y & 7)) & 1:
+                i = y * w + x
+                dst[i >> 3] |= 0x80 >> (i & 7)
+
+
+@micropython.viper
+def mono_vlsb_from_bmp(dst: ptr8, src: ptr8, w: int, h: int):
+    # `src` is a 1-bit MicroBMP pixel array, packed row by row, MSB first.
+    # `dst` is a cleared MONO_VLSB buffer, one byte for 8 vertical pixels.
+    for y in range(h):
+        for x in range(w):
+            i = y * w + x
+            if (src[i >> 3] >> (7 - (i & 7))) & 1:
+                dst[x + (y >> 3) * w] |= 1 << (y & 7)
+
+
+@micropython.viper
+def mono_vlsb_mirror_h(dst: ptr8, src: ptr8, w: int, h: int):
+    # Both `src` and `dst` are MONO_VLSB buffers of the same size.
+    # A horizontal mirror keeps each column byte, only the order is reversed.
+    for p in range((h + 7) >> 3):
+        i = p * w
+        for x in range(w):
+            dst[i + x] = src[i + w - x - 1]
+
+
+@micropython.viper
+def cells_solved(cells: ptr8, n: int) -> bool:
+    # Every cell must have both or neither of GOAL (bit 1) and BOX (bit 2).
+    for i in range(n):
+        c = cells[i]
+        if ((c >> 1) ^ (c >> 2)) & 1:
+            return False
+    return True
 
 
 def framebuf_from_img(img_path):
+    # The decoded image is cached next to it as a `.fbuf` file,
+    # a little endian (w, h) header of 2 bytes each followed by the buffer.
+    # It is only trusted when it is not older than the image,
+    # its size is not zero and its length matches the header,
+    # else the image is decoded again.
+    fbuf_path = img_path + ".fbuf"
+    try:
+        fbuf_stat = os.stat(fbuf_path)
+        if fbuf_stat[8] >= os.stat(img_path)[8]:
+            with open(fbuf_path, "rb") as file:
+                header = file.read(4)
+                w = header[0] | header[1] << 8
+                h = header[2] | header[3] << 8
+                buf_len = w * ((h + 7) >> 3)
+                if w and h and fbuf_stat[6] == 4 + buf_len:
+                    buf = bytearray(buf_len)
+                    if file.readinto(buf) == buf_len:
+                        return FrameBuffer(buf, w, h, MONO_VLSB)
+    except (OSError, IndexError):
+        pass
+
     img = MicroBMP().load(img_path)
-    fb = FrameBuffer(
-        bytearray(img.DIB_w * ceil(img.DIB_h / 8)),
-        img.DIB_w,
-        img.DIB_h,
-        MONO_VLSB,
-    )
+    w, h = img.DIB_w, img.DIB_h
+    buf = bytearray(w * ((h + 7) >> 3))
+    mono_vlsb_from_bmp(buf, img.parray, w, h)
 
-    for y in range(img.DIB_h):
-        for x in range(img.DIB_w):
-            fb.pixel(x, y, img[x, y])
+    try:
+        with open(fbuf_path, "wb") as file:
+            file.write(bytes((w & 0xFF, w >> 8, h & 0xFF, h >> 8)))
+            file.write(buf)
+    except OSError:
+        pass
 
-    return fb
+    return FrameBuffer(buf, w, h, MONO_VLSB)
 
 
 def mirror_framebuf_h(fb, w, h):
-    new_fb = FrameBuffer(bytearray(w * ceil(h / 8)), w, h, MONO_VLSB)
-    for y in range(h):
-        for x in range(w):
-            new_fb.pixel(x, y, fb.pixel(w - x - 1, y))
-    return new_fb
+    buf = bytearray(w * ((h + 7) >> 3))
+    mono_vlsb_mirror_h(buf, fb, w, h)
+    return FrameBuffer(buf, w, h, MONO_VLSB)
 
 
 class Menu:
     def __init__(self):
-        self.levels = os.listdir(LEVELS_DIR)
+        self.levels = tuple(sorted(os.listdir(LEVELS_DIR)))
+        # Centred menu texts, without the file extensions.
+        self.level_texts = tuple(f"{level.split('.')[0]:^12s}" for level in self.levels)
         self.max_show_num = GameScreen.HEIGHT // 8 + 3
 
         self.cur_idx = None
@@ -83,52 +143,58 @@ class Menu:
 class SokobanBoard:
     UP, LEFT, DOWN, RIGHT = tuple(range(1, 5))
 
+    # Flags of a cell in `cells`.
+    WALL = 1
+    GOAL = 2
+    BOX = 4
+
+    # (dx, dy) of one step, indexed by direction.
+    STEPS = ((0, 0), (0, -1), (-1, 0), (0, 1), (1, 0))
+
     def __init__(self):
         self.clear()
 
     def __str__(self):
         self._grid = [[" " for c in range(self.nc)] for r in range(self.nr)]
 
-        for wall in self.walls:
-            self._grid[wall.y][wall.x] = "#"
+        for x, y in self.positions(self.WALL):
+            self._grid[y][x] = "#"
 
-        for goal in self.goals:
-            self._grid[goal.y][goal.x] = "."
+        for x, y in self.positions(self.GOAL):
+            self._grid[y][x] = "."
 
-        for box in self.boxes:
-            if box in self.goals:
-                self._grid[box.y][box.x] = "*"
+        for x, y in self.positions(self.BOX):
+            if self.cells[y * self.nc + x] & self.GOAL:
+                self._grid[y][x] = "*"
             else:
-                self._grid[box.y][box.x] = "$"
+                self._grid[y][x] = "$"
 
-        if self.player in self.goals:
-            self._grid[self.player.y][self.player.x] = "+"
+        if self.cells[self.player_y * self.nc + self.player_x] & self.GOAL:
+            self._grid[self.player_y][self.player_x] = "+"
         else:
-            self._grid[self.player.y][self.player.x] = "@"
+            self._grid[self.player_y][self.player_x] = "@"
 
         return "\n".join(["".join(line) for line in self._grid])
 
-    def _can_move(self, direction):
-        if self.player:
-            if direction == self.UP:
-                pp = Point(self.player.x, self.player.y - 1)
-                bp = Point(self.player.x, self.player.y - 2)
-            elif direction == self.LEFT:
-                pp = Point(self.player.x - 1, self.player.y)
-                bp = Point(self.player.x - 2, self.player.y)
-            elif direction == self.DOWN:
-                pp = Point(self.player.x, self.player.y + 1)
-                bp = Point(self.player.x, self.player.y + 2)
-            elif direction == self.RIGHT:
-                pp = Point(self.player.x + 1, self.player.y)
-                bp = Point(self.player.x + 2, self.player.y)
-            else:
-                return False
+    def _cell_idx(self, x, y):
+        # Index of (x, y) in `cells`, -1 if it is off the board.
+        if 0 <= x < self.nc and 0 <= y < self.nr:
+            return y * self.nc + x
+        return -1
 
-            if pp in self.walls:
+    def _can_move(self, direction):
+        if self.player_x is not None and self.UP <= direction <= self.RIGHT:
+            dx, dy = self.STEPS[direction]
+            x = self.player_x + dx
+            y = self.player_y + dy
+            cells = self.cells
+
+            pi = self._cell_idx(x, y)
+            if pi < 0 or cells[pi] & self.WALL:
                 return False
-            elif pp in self.boxes:
-                if bp in (self.boxes | self.walls):
+            elif cells[pi] & self.BOX:
+                bi = self._cell_idx(x + dx, y + dy)
+                if bi < 0 or cells[bi] & (self.BOX | self.WALL):
                     return False
                 else:
                     return True
@@ -138,10 +204,9 @@ class SokobanBoard:
         return False
 
     def clear(self):
-        self.player = None
-        self.walls = set()
-        self.goals = set()
-        self.boxes = set()
+        self.player_x = None
+        self.player_y = None
+        self.cells = bytearray(0)
         self.nr = 0
         self.nc = 0
 
@@ -150,60 +215,60 @@ class SokobanBoard:
         with open(board_path) as file:
             self._grid = [[char for char in line.rstrip()] for line in file]
 
+        self.nr = len(self._grid)
+        self.nc = max([len(row) for row in self._grid])
+        self.cells = bytearray(self.nr * self.nc)
+
         for y, row in enumerate(self._grid):
             for x, char in enumerate(row):
+                i = y * self.nc + x
                 if char == "@":
-                    self.player = Point(x, y)
+                    self.player_x, self.player_y = x, y
                 elif char == "#":
-                    self.walls.add(Point(x, y))
+                    self.cells[i] |= self.WALL
                 elif char == ".":
-                    self.goals.add(Point(x, y))
+                    self.cells[i] |= self.GOAL
                 elif char == "*":
-                    self.goals.add(Point(x, y))
-                    self.boxes.add(Point(x, y))
+                    self.cells[i] |= self.GOAL | self.BOX
                 elif char == "+":
-                    self.goals.add(Point(x, y))
-                    self.player = Point(x, y)
+                    self.cells[i] |= self.GOAL
+                    self.player_x, self.player_y = x, y
                 elif char == "$":
-                    self.boxes.add(Point(x, y))
+                    self.cells[i] |= self.BOX
 
-        self.nr = len(self._grid)
-        self.nc = max([len(row) for row in self._grid])
+    def positions(self, flag):
+        nc = self.nc
+        for i, cell in enumerate(self.cells):
+            if cell & flag:
+                yield i % nc, i // nc
 
     def move(self, direction):
         if self._can_move(direction):
-            if direction == self.UP:
-                self.player = Point(self.player.x, self.player.y - 1)
-                if self.player in self.boxes:
-                    self.boxes.discard(self.player)
-                    self.boxes.add(Point(self.player.x, self.player.y - 1))
-            elif direction == self.LEFT:
-                self.player = Point(self.player.x - 1, self.player.y)
-                if self.player in self.boxes:
-                    self.boxes.discard(self.player)
-                    self.boxes.add(Point(self.player.x - 1, self.player.y))
-            elif direction == self.DOWN:
-                self.player = Point(self.player.x, self.player.y + 1)
-                if self.player in self.boxes:
-                    self.boxes.discard(self.player)
-                    self.boxes.add(Point(self.player.x, self.player.y + 1))
-            elif direction == self.RIGHT:
-                self.player = Point(self.player.x + 1, self.player.y)
-                if self.player in self.boxes:
-                    self.boxes.discard(self.player)
-                    self.boxes.add(Point(self.player.x + 1, self.player.y))
+            dx, dy = self.STEPS[direction]
+            self.player_x += dx
+            self.player_y += dy
+
+            cells = self.cells
+            i = self.player_y * self.nc + self.player_x
+            if cells[i] & self.BOX:
+                cells[i] &= ~self.BOX
+                cells[i + dy * self.nc + dx] |= self.BOX
 
             return True
 
         return False
 
     def is_solved(self):
-        return not (self.goals ^ self.boxes)
+        return cells_solved(self.cells, len(self.cells))
 
 
 class GameKeyBoard(InputDevice):
     NUM_OF_KEYS = 6
     BACK, UP, ENTER, LEFT, DOWN, RIGHT = tuple(range(NUM_OF_KEYS))
+    # Masks of the keys in `keys_on`, `keys_off`, etc.
+    M_BACK, M_UP, M_ENTER = 1 << BACK, 1 << UP, 1 << ENTER
+    M_LEFT, M_DOWN, M_RIGHT = 1 << LEFT, 1 << DOWN, 1 << RIGHT
+    M_ALL = (1 << NUM_OF_KEYS) - 1
 
     PIN_BACK = 32
     PIN_UP = 15
@@ -219,6 +284,8 @@ class GameKeyBoard(InputDevice):
     THRE_DOWN = 590
     THRE_RIGHT = 520
 
+    POLL_MS = 8
+
     def __init__(self):
         super().__init__()
 
@@ -238,24 +305,47 @@ class GameKeyBoard(InputDevice):
             self.THRE_DOWN,
             self.THRE_RIGHT,
         ]
-        self.keys_all = set(range(self.NUM_OF_KEYS))
-
-        self.keys_on = set()
-        self.keys_off = self.keys_all - self.keys_on
-        self.keys_pressed = set()
-        self.keys_released = set()
-
+        # Key states are bitmasks, bit `i` stands for key `i`.
+        self.keys_on = 0
+        self.keys_off = self.M_ALL
+        self.keys_pressed = 0
+        self.keys_released = 0
+
+        # Keys touched between frames, so short touches are not missed.
+        self.poll_ms = self.POLL_MS
+        self._keys_polled = 0
+
+    @micropython.native
+    def _read_keys(self):
+        # Unrolled for the native emitter, bit `i` stands for key `i`.
+        keys = self.keys
+        thresholds = self._thresholds
+        keys_on = 0
+        if keys[0].read() < thresholds[0]:
+            keys_on |= 1
+        if keys[1].read() < thresholds[1]:
+            keys_on |= 2
+        if keys[2].read() < thresholds[2]:
+            keys_on |= 4
+        if keys[3].read() < thresholds[3]:
+            keys_on |= 8
+        if keys[4].read() < thresholds[4]:
+            keys_on |= 16
+        if keys[5].read() < thresholds[5]:
+            keys_on |= 32
+        return keys_on
+
+    def poll(self):
+        self._keys_polled |= self._read_keys()
+
+    @micropython.native
     def update(self):
-        old_keys_on = self.keys_on
-        old_keys_off = self.keys_off
-
-        self.keys_on = set()
-        for i in range(len(self.keys)):
-            if self.keys[i].read() < self._thresholds[i]:
-                self.keys_on.add(i)
-        self.keys_off = self.keys_all - self.keys_on
-        self.keys_pressed = self.keys_on - old_keys_on
-        self.keys_released = self.keys_off - old_keys_off
+        keys_on = self._read_keys() | self._keys_polled
+        self._keys_polled = 0
+        self.keys_pressed = keys_on & ~self.keys_on
+        self.keys_released = self.keys_on & ~keys_on
+        self.keys_on = keys_on
+        self.keys_off = self.M_ALL ^ keys_on
 
 
 class GameScreen(Screen):
@@ -274,17 +364,15 @@ class GameScreen(Screen):
         self.h = self.HEIGHT
 
     def print_screen(self, img):
-        for y in range(img.DIB_h):
-            for x in range(img.DIB_w):
-                img[x, y] = self.display.pixel(x, y)
+        bmp_from_mono_vlsb(img.parray, self.display.buffer, img.DIB_w, img.DIB_h)
 
     def update(self):
         self.display.show()
 
         keyboard = self.manager.input_device
         if (
-            GameKeyBoard.ENTER in keyboard.keys_on
-            and GameKeyBoard.BACK in keyboard.keys_released
+            keyboard.keys_on & GameKeyBoard.M_ENTER
+            and keyboard.keys_released & GameKeyBoard.M_BACK
         ):
             print("Printing screen...")
             img_screen = MicroBMP(128, 64, 1)
@@ -329,9 +417,9 @@ class Player(Sprite):
         self.is_moving = False
 
     def update(self):
-        target_point = self.manager.board.player
-        target_x = target_point.x * self.WIDTH
-        target_y = target_point.y * self.HEIGHT
+        board = self.manager.board
+        target_x = board.player_x * self.WIDTH
+        target_y = board.player_y * self.HEIGHT
         if self.x < target_x:
             self.vx = 2
             self.is_moving = True
@@ -352,20 +440,33 @@ class Player(Sprite):
             self.is_moving = False
 
 
-class Wall(Sprite):
-    WIDTH = 8
-    HEIGHT = 8
+class Walls(Sprite):
+    TILE_WIDTH = 8
+    TILE_HEIGHT = 8
 
-    FB0 = framebuf_from_img(IMAGES_DIR + "wall00.bmp")
+    FB_TILE = framebuf_from_img(IMAGES_DIR + "wall00.bmp")
 
-    def __init__(self, x, y):
+    # Only one level is shown at a time, so its walls share this memory.
+    _fb_buf = bytearray(0)
+
+    def __init__(self, board):
         super().__init__()
 
-        self.x = x
-        self.y = y
-        self.w = self.WIDTH
-        self.h = self.HEIGHT
-        self.imgs = [self.FB0]
+        # Walls never move, so all of them are drawn once into one image
+        # of the whole board, found from the board cells.
+        self.w = board.nc * self.TILE_WIDTH
+        self.h = board.nr * self.TILE_HEIGHT
+        buf_len = self.w * ((self.h + 7) >> 3)
+        if len(Walls._fb_buf) < buf_len:
+            Walls._fb_buf = bytearray(buf_len)
+        fb = FrameBuffer(Walls._fb_buf, self.w, self.h, MONO_VLSB)
+        fb.fill(0)
+        for x, y in board.positions(board.WALL):
+            fb.blit(self.FB_TILE, x * self.TILE_WIDTH, y * self.TILE_HEIGHT)
+        self.imgs = [fb]
+        # The image covers the whole board, so the cells between the walls
+        # must not hide the goals sharing its layer, whatever the blit order.
+        self.colourkey = 0
 
 
 class Goal(Sprite):
@@ -408,8 +509,7 @@ class Box(Sprite):
         self.colourkey = 0
         self.set_layer(1)
 
-    def update(self):
-        player = self.manager.player
+    def push_by(self, player):
         collision = self.check_collision(player)
         if collision:
             if collision[0] == self.UP:
@@ -434,8 +534,8 @@ class CameraTarget(Sprite):
 
     def update(self):
         if self.following:
-            self.x = self.following.x - (self.w - self.following.w) / 2
-            self.y = self.following.y - (self.h - self.following.h) / 2
+            self.x = self.following.x - (self.w - self.following.w) // 2
+            self.y = self.following.y - (self.h - self.following.h) // 2
             if self.boundary:
                 self.clamp_position(
                     self.boundary.up,
@@ -463,10 +563,15 @@ class Overlay(Sprite):
         self.is_overlay = True
         self.set_layer(255)
 
+        self._text = None
         self._lines = []
         self._has_outline = False
         self._invert = False
 
+        # The frame buffer memory is kept and reused while it is big enough.
+        self._fb_buf = bytearray(0)
+        self._rendered = None
+
     def set_text(
         self,
         text=None,
@@ -475,7 +580,18 @@ class Overlay(Sprite):
         has_outline=None,
         invert=None,
     ):
+        if (
+            text == self._text
+            and anchor_h is None
+            and anchor_v is None
+            and (has_outline is None or has_outline == self._has_outline)
+            and (invert is None or invert == self._invert)
+        ):
+            # Nothing changes.
+            return
+
         if text is not None:
+            self._text = text
             self._lines = text.splitlines()
 
         if has_outline is not None:
@@ -495,23 +611,26 @@ class Overlay(Sprite):
         if anchor_h == self.H_LEFT:
             self.x = 0
         elif anchor_h == self.H_CENTER:
-            self.x = (GameScreen.WIDTH - self.w) / 2
+            self.x = (GameScreen.WIDTH - self.w) // 2
         elif anchor_h == self.H_CENTER:
             self.x = GameScreen.WIDTH - self.w
 
         if anchor_v == self.V_TOP:
             self.y = 0
         elif anchor_v == self.V_CENTER:
-            self.y = (GameScreen.HEIGHT - self.h) / 2
+            self.y = (GameScreen.HEIGHT - self.h) // 2
         elif anchor_v == self.V_BOTTOM:
             self.y = GameScreen.HEIGHT - self.h
 
-        fb = FrameBuffer(
-            bytearray(self.w * ceil(self.h / 8)),
-            self.w,
-            self.h,
-            MONO_VLSB,
-        )
+        rendered = (self._lines, self._has_outline, self._invert)
+        if rendered == self._rendered:
+            return
+        self._rendered = rendered
+
+        buf_len = self.w * ((self.h + 7) >> 3)
+        if len(self._fb_buf) < buf_len:
+            self._fb_buf = bytearray(buf_len)
+        fb = FrameBuffer(self._fb_buf, self.w, self.h, MONO_VLSB)
 
         fb.fill(1 if self._invert else 0)
         if self._has_outline:
@@ -526,22 +645,31 @@ class Overlay(Sprite):
 class PopUp(Overlay):
     WIDTH = 15
 
+    # Button rows by buttons, shared by all pop-ups.
+    _btn_texts = {}
+
     def __init__(self, name="", text="", buttons=None):
         super().__init__()
 
+        # Above the other overlays, sprites sharing a layer have no fixed order.
+        self.set_layer(256)
         self.name = name
         self._has_outline = True
         self.buttons = buttons or ["OK"]
         self.result = None
 
-        if len(self.buttons) == 1:
-            btn_text = " " * (self.WIDTH - len(self.buttons[0])) + self.buttons[0]
-        else:
-            btn_text = (
-                self.buttons[0]
-                + " " * (self.WIDTH - len(self.buttons[0]) - len(self.buttons[1]))
-                + self.buttons[1]
-            )
+        key = tuple(self.buttons)
+        btn_text = self._btn_texts.get(key)
+        if btn_text is None:
+            if len(self.buttons) == 1:
+                btn_text = " " * (self.WIDTH - len(self.buttons[0])) + self.buttons[0]
+            else:
+                btn_text = (
+                    self.buttons[0]
+                    + " " * (self.WIDTH - len(self.buttons[0]) - len(self.buttons[1]))
+                    + self.buttons[1]
+                )
+            self._btn_texts[key] = btn_text
 
         self.set_text(
             text + "\n" + btn_text,
@@ -554,15 +682,15 @@ class PopUp(Overlay):
     def update(self):
         keyboard = self.manager.input_device
         if len(self.buttons) == 1:
-            if GameKeyBoard.ENTER in keyboard.keys_released:
+            if keyboard.keys_released & GameKeyBoard.M_ENTER:
                 self.result = self.buttons[0]
         else:
             if (
-                GameKeyBoard.ENTER not in keyboard.keys_on
-                and GameKeyBoard.BACK in keyboard.keys_released
+                not (keyboard.keys_on & GameKeyBoard.M_ENTER)
+                and keyboard.keys_released & GameKeyBoard.M_BACK
             ):
                 self.result = self.buttons[0]
-            if GameKeyBoard.ENTER in keyboard.keys_released:
+            if keyboard.keys_released & GameKeyBoard.M_ENTER:
                 self.result = self.buttons[1]
 
 
@@ -576,6 +704,7 @@ class GameManager(Manager):
         self.screen = GameScreen()
         self.screen.manager = self
         self.menu = Menu()
+        self._menu_items = []
         self.board = SokobanBoard()
 
         self._popup_result = {}
@@ -632,31 +761,35 @@ class GameManager(Manager):
         self.set_camera(None)
         self.kill_sprites()
 
+        # The rows are created once and only redrawn when navigating.
+        self._menu_items = []
+        for _ in range(self.menu.start_idx, self.menu.end_idx + 1):
+            menu_item = Overlay()
+            self.add_sprite(menu_item)
+            self._menu_items.append(menu_item)
+
         self.update_menu()
 
     def update_menu(self):
-        self.kill_sprites()
-        for i in range(self.menu.start_idx, self.menu.end_idx + 1):
-            text = f"{self.menu.levels[i].split('.')[0]:^12s}"
-            menu_item = Overlay()
-            y = GameScreen.HEIGHT // 2 - 4 + (i - self.menu.cur_idx) * 8
-            menu_item.y = y
+        menu = self.menu
+        for row, i in enumerate(range(menu.start_idx, menu.end_idx + 1)):
+            menu_item = self._menu_items[row]
+            menu_item.y = GameScreen.HEIGHT // 2 - 4 + (i - menu.cur_idx) * 8
             menu_item.set_text(
-                text=text,
+                text=menu.level_texts[i],
                 anchor_h=Overlay.H_CENTER,
-                invert=True if i == self.menu.cur_idx else False,
+                invert=True if i == menu.cur_idx else False,
             )
-            self.add_sprite(menu_item)
 
     def handle_menu(self):
         keyboard = self.input_device
-        if GameKeyBoard.UP in keyboard.keys_pressed:
+        if keyboard.keys_pressed & GameKeyBoard.M_UP:
             self.menu.set_cur_idx(self.menu.cur_idx - 1)
             self.update_menu()
-        elif GameKeyBoard.DOWN in keyboard.keys_pressed:
+        elif keyboard.keys_pressed & GameKeyBoard.M_DOWN:
             self.menu.set_cur_idx(self.menu.cur_idx + 1)
             self.update_menu()
-        elif GameKeyBoard.ENTER in keyboard.keys_released:
+        elif keyboard.keys_released & GameKeyBoard.M_ENTER:
             self.init_level()
 
     def init_level(self):
@@ -666,8 +799,8 @@ class GameManager(Manager):
         self.board.load(LEVELS_DIR + self.menu.cur_level)
 
         self.player = Player(
-            self.board.player.x * Player.WIDTH,
-            self.board.player.y * Player.HEIGHT,
+            self.board.player_x * Player.WIDTH,
+            self.board.player_y * Player.HEIGHT,
         )
         self.add_sprite(self.player)
 
@@ -679,14 +812,22 @@ class GameManager(Manager):
         right = bw
         self.set_camera(self.player, CameraTargetBoundary(up, left, down, right))
 
-        for wall in self.board.walls:
-            self.add_sprite(Wall(wall.x * Wall.WIDTH, wall.y * Wall.HEIGHT))
-        for goal in self.board.goals:
-            self.add_sprite(Goal(goal.x * Goal.WIDTH, goal.y * Goal.HEIGHT))
-        for box in self.board.boxes:
-            self.add_sprite(Box(box.x * Box.WIDTH, box.y * Box.HEIGHT))
+        self.add_sprite(Walls(self.board))
+        for x, y in self.board.positions(SokobanBoard.GOAL):
+            self.add_sprite(Goal(x * Goal.WIDTH, y * Goal.HEIGHT))
+        for x, y in self.board.positions(SokobanBoard.BOX):
+            self.add_sprite(Box(x * Box.WIDTH, y * Box.HEIGHT))
+
+    def push_boxes(self):
+        # The player touches at most one box.
+        player = self.player
+        boxes = self.get_colliding_sprites(player, Box)
+        if boxes:
+            boxes[0].push_by(player)
 
     def handle_level(self):
+        self.push_boxes()
+
         if self.handle_popup():
             return
 
@@ -701,8 +842,8 @@ class GameManager(Manager):
             return
 
         if (
-            GameKeyBoard.ENTER not in keyboard.keys_on
-            and GameKeyBoard.BACK in keyboard.keys_released
+            not (keyboard.keys_on & GameKeyBoard.M_ENTER)
+            and keyboard.keys_released & GameKeyBoard.M_BACK
         ):
             self.popup("Back", "Back to menu?\n", ["NO", "YES"])
             return
@@ -712,13 +853,14 @@ class GameManager(Manager):
             return
 
         if (not self.board.is_solved()) and (not self.player.is_moving):
-            if GameKeyBoard.UP in keyboard.keys_on:
+            keys_on = keyboard.keys_on
+            if keys_on & GameKeyBoard.M_UP:
                 self.board.move(SokobanBoard.UP)
-            elif GameKeyBoard.LEFT in keyboard.keys_on:
+            elif keys_on & GameKeyBoard.M_LEFT:
                 self.board.move(SokobanBoard.LEFT)
-            elif GameKeyBoard.DOWN in keyboard.keys_on:
+            elif keys_on & GameKeyBoard.M_DOWN:
                 self.board.move(SokobanBoard.DOWN)
-            elif GameKeyBoard.RIGHT in keyboard.keys_on:
+            elif keys_on & GameKeyBoard.M_RIGHT:
                 self.board.move(SokobanBoard.RIGHT)
 
     def update(self):
@@ -5,13 +5,25 @@
 """
 
 __version__ = "0.1.0"
-__all__ = ["AppEngineException", "InputDevice", "Screen", "Sprite", "Manager"]
+__all__ = [
+    "AppEngineException",
+    "InputDevice",
+    "Screen",
+    "Sprite",
+    "Manager",
+    "sprite_aabb_overlap",
+]
 
 import gc
-from time import ticks_us, ticks_diff
+import micropython
+from heapq import heappush, heappop
+from time import ticks_us, ticks_diff, sleep_us
 import uasyncio as asyncio
 
 US_PER_S = 1000000
+US_PER_MS = 1000
+SLEEP_THRESHOLD_US = 500
+SLEEP_MARGIN_US = 200
 STR_NEEDS_SUBCLASS = "Needs to be overridden by a subclass."
 
 
@@ -24,15 +36,34 @@ class AppEngineException(Exception):
 class InputDevice:
     """A class for the input device.
 
+    Attributes:
+        poll_ms (int):
+            If greater than `0`, `poll()` is called every `poll_ms` milliseconds
+            in a separate task, when the app runs with `Manager.arun()`.
+
     Note:
         This class needs to be subclassed to be useful.
         Override `__init__()` to initialise the input device.
         Override `update()` to implement the logic of the input device.
+        Optionally override `poll()` to sample the input device between frames.
     """
 
+    poll_ms = 0
+
     def __init__(self):
         pass
 
+    def poll(self):
+        """This method may sample the input device between frames.
+
+        It is called every `poll_ms` milliseconds when `poll_ms` is greater than `0`
+        and the app runs with `Manager.arun()`.
+        The samples should be accumulated, so `update()` can take them into account.
+        For example, a short touch between two frames can be remembered here.
+        """
+
+        pass
+
     def update(self):
         """This method should implement the logic of the input device.
 
@@ -62,6 +93,14 @@ class Screen:
         camera_target (Sprite):
             If not `None`, the screen camera will follow this sprite.
             The center of this sprite will be placed at the center of the screen.
+        partial_clear (bool):
+            `False` by default, the whole screen buffer is cleared before each frame.
+            If `True`, only the areas the sprites were blitted to
+            in the last frame are cleared, which is much less work.
+            It needs the `w` and `h` of every sprite to cover its image,
+            and nothing else drawn onto `display` between frames.
+            The whole buffer is still cleared after a sprite without a size
+            is blitted.
 
     Note:
         This class needs to be subclassed to be useful.
@@ -69,26 +108,98 @@ class Screen:
         Override `update()` to show the content of the screen from its buffer.
     """
 
+    partial_clear = False
+
+    # Class level defaults, so a subclass not calling `__init__()` still works.
+    _cam_dx = 0
+    _cam_dy = 0
+    # Rectangles blitted in the last frame, as flat `x, y, w, h` ints,
+    # the list is created per screen on first use.
+    _dirty_rects = None
+    _dirty_all = True
+
     def __init__(self):
         self.display = None
         self.w = 0
         self.h = 0
         self.camera_target = None
 
+    @micropython.native
+    def _begin_frame(self):
+        """Clear the screen buffer and update the cached camera translation.
+
+        It is called once before blitting the sprites of every frame by the manager.
+        """
+
+        dirty_rects = self._dirty_rects
+        if dirty_rects is None:
+            dirty_rects = self._dirty_rects = []
+        partial_clear = self.partial_clear
+        full = self._dirty_all or not partial_clear
+        if not full:
+            area = 0
+            for i in range(2, len(dirty_rects), 4):
+                area += dirty_rects[i] * dirty_rects[i + 1]
+            # Clearing more than the screen area costs more than one full clear.
+            full = area >= self.w * self.h
+
+        if full:
+            self.display.fill(0)
+        else:
+            fill_rect = self.display.fill_rect
+            for i in range(0, len(dirty_rects), 4):
+                fill_rect(
+                    dirty_rects[i],
+                    dirty_rects[i + 1],
+                    dirty_rects[i + 2],
+                    dirty_rects[i + 3],
+                    0,
+                )
+        del dirty_rects[:]
+        # Nothing is recorded without partial clearing,
+        # so the first frame after turning it on clears everything.
+        self._dirty_all = not partial_clear
+        self._update_camera_cache()
+
+    def _update_camera_cache(self, _int: type = int):
+        """Update the cached camera translation.
+
+        The translation is not rounded, only the final position is in `blit()`.
+        A whole number is kept as an `int`, so integer positions stay integers.
+
+        Args:
+            _int:
+                `int` bound as a local for speed, not to be passed in.
+        """
+
+        if self.camera_target:
+            ct = self.camera_target
+            dx = ct.x + (ct.w - self.w) / 2
+            dy = ct.y + (ct.h - self.h) / 2
+            self._cam_dx = _int(dx) if dx == _int(dx) else dx
+            self._cam_dy = _int(dy) if dy == _int(dy) else dy
+        else:
+            self._cam_dx = 0
+            self._cam_dy = 0
+
     def clear(self):
         """Clear the screen buffer and update it."""
 
         self.display.fill(0)
         self.update()
 
-    def blit(self, sprite: Sprite):
+    def blit(self, sprite: Sprite, _int: type = int):
         """Blit the sprite at its position in the screen.
 
         It is called before every frame for each sprite added to the manager.
+        A sprite with a non-zero size that is completely off the screen
+        is not blitted, its `w` and `h` should cover its image.
 
         Args:
             sprite:
                 A sprite to be placed in the screen at its position.
+            _int:
+                `int` bound as a local for speed, not to be passed in.
         """
 
         img = sprite._get_img()
@@ -98,20 +209,39 @@ class Screen:
             if self.camera_target and not sprite.is_overlay:
                 # Camera target exists and this sprite is not overlay.
                 # Translate position according to camera target position.
-                ct = self.camera_target
-                x -= ct.x + (ct.w - self.w) / 2
-                y -= ct.y + (ct.h - self.h) / 2
-
-            self.display.blit(img, int(x), int(y), sprite.colourkey)
+                x -= self._cam_dx
+                y -= self._cam_dy
+
+            w = sprite.w
+            h = sprite.h
+            if w and h and (x + w <= 0 or y + h <= 0 or x >= self.w or y >= self.h):
+                # Completely off the screen.
+                return
+
+            x = _int(x)
+            y = _int(y)
+            self.display.blit(img, x, y, sprite.colourkey)
+            if self.partial_clear:
+                if w and h:
+                    dirty_rects = self._dirty_rects
+                    if dirty_rects is None:
+                        dirty_rects = self._dirty_rects = []
+                    dirty_rects.append(x)
+                    dirty_rects.append(y)
+                    dirty_rects.append(w)
+                    dirty_rects.append(h)
+                else:
+                    # The extent of the image is unknown.
+                    self._dirty_all = True
 
     def flip(self):
-        """Update the screen and clear the screen buffer.
+        """Update the screen.
 
-        It is called before every frame by the manager.
+        It is called after every frame by the manager.
+        The screen buffer is cleared before blitting the next frame.
         """
 
         self.update()
-        self.display.fill(0)
 
     def update(self):
         """This method should show the content of the screen from its buffer.
@@ -128,6 +258,47 @@ class Screen:
         raise AppEngineException(STR_NEEDS_SUBCLASS)
 
 
+@micropython.native
+def sprite_aabb_overlap(
+    ax: float,
+    ay: float,
+    aw: int,
+    ah: int,
+    bx: float,
+    by: float,
+    bw: int,
+    bh: int,
+) -> bool:
+    """Check whether two axis-aligned bounding boxes overlap.
+
+    It is a cheap test without any information of where the overlap happened.
+    Touching edges do not count as overlap.
+
+    Args:
+        ax:
+            The x position of box A.
+        ay:
+            The y position of box A.
+        aw:
+            The width of box A.
+        ah:
+            The height of box A.
+        bx:
+            The x position of box B.
+        by:
+            The y position of box B.
+        bw:
+            The width of box B.
+        bh:
+            The height of box B.
+
+    Returns:
+        The two boxes overlap or not.
+    """
+
+    return ax < bx + bw and ax + aw > bx and ay < by + bh and ay + ah > by
+
+
 class Sprite:
     """A class for app sprites.
 
@@ -158,7 +329,7 @@ class Sprite:
         img_idx (int):
             The index of the image to be shown.
         img_fpstep_counter (int):
-            Frames per step counter for animation.
+            Frames left in the current step of animation.
         colourkey (int):
             Transparent colour, `-1` means no transparent colour.
         is_overlay (bool):
@@ -170,6 +341,7 @@ class Sprite:
             The name of the sprite.
         killed (bool):
             If True, the sprite will be removed by the manager.
+            Call `kill()` to set it, so the manager is notified.
 
     Note:
         This class needs to be subclassed to be useful.
@@ -200,28 +372,30 @@ class Sprite:
 
         self.manager = None
         self.name = ""
-        self.killed = False
+        self._killed = False
         self._frames_to_kill = None
+        self._kill_frame = None
 
+    @micropython.native
     def _frame_routine(self):
         """Frame routine of the sprite.
 
         This method is called before every frame by the manager.
         The position of the sprite is updated according to the velocity.
-        It maintains the timer to kill the sprite in a delayed manner.
         At last it calls `update()` method for the customised logic.
         """
 
-        self.x += self.vx
-        self.y += self.vy
-
-        if self._frames_to_kill is not None:
-            self._frames_to_kill -= 1
-            if self._frames_to_kill <= 0:
-                self.killed = True
+        # Static sprites are common, skip the update for a zero velocity.
+        vx = self.vx
+        if vx:
+            self.x += vx
+        vy = self.vy
+        if vy:
+            self.y += vy
 
         self.update()
 
+    @micropython.native
     def _get_img(self) -> FrameBuffer:
         """Get the current image of the sprite.
 
@@ -232,20 +406,31 @@ class Sprite:
             The current image of the sprite or `None`.
         """
 
-        if not self.imgs:
+        imgs = self.imgs
+        if not imgs:
             return None
 
-        # Keep `self.img_idx` within animation range.
-        self.img_idx = (
-            (self.img_idx - self._img_start) % self._img_len + self._img_start
-            if self._img_len
-            else self._img_start
-        )
-        current_img = self.imgs[self.img_idx]
-
-        self.img_fpstep_counter = (self.img_fpstep_counter + 1) % self._img_fpstep
-        if self.img_fpstep_counter == 0:
-            self.img_idx += 1
+        if self._img_len <= 1:
+            # A still image always shows its start image,
+            # there are no frames to count.
+            img_start = self._img_start
+            if self.img_idx != img_start:
+                self.img_idx = img_start
+            return imgs[img_start]
+
+        img_idx = self.img_idx
+        current_img = imgs[img_idx]
+
+        # Count down the frames of the current step,
+        # and wrap `self.img_idx` around at the end of animation range.
+        counter = self.img_fpstep_counter - 1
+        if counter <= 0:
+            counter = self._img_fpstep
+            img_idx += 1
+            if img_idx >= self._img_start + self._img_len:
+                img_idx = self._img_start
+            self.img_idx = img_idx
+        self.img_fpstep_counter = counter
 
         return current_img
 
@@ -264,6 +449,7 @@ class Sprite:
         """Set the layer in which the sprite is located.
 
         A larger number means the sprite is in a more upper layer.
+        Sprites in the same layer are blitted in no particular order.
 
         Args:
             layer:
@@ -272,7 +458,7 @@ class Sprite:
 
         self._layer = layer
         if self.manager:
-            self.manager._sort_sprites_by_layer()
+            self.manager._layers_dirty = True
 
     def setup_animation(self, start: int, length: int, fpstep: int):
         """Setup animation for the sprite.
@@ -284,11 +470,24 @@ class Sprite:
                 The length of the images for animation.
             fpstep:
                 Frames per step for animation speed.
+
+        Note:
+            Animation restarts from `start` only when any setting changes,
+            so it is fine to call this method every frame.
         """
 
+        if (
+            start == self._img_start
+            and length == self._img_len
+            and fpstep == self._img_fpstep
+        ):
+            return
+
         self._img_start = start
         self._img_len = length
         self._img_fpstep = fpstep
+        self.img_idx = start
+        self.img_fpstep_counter = fpstep
 
     def clamp_position(
         self,
@@ -326,6 +525,38 @@ class Sprite:
         if (up is not None) and (self.y < up):
             self.y = up
 
+    @micropython.native
+    def clamp_position_box(self, up: float, left: float, down: float, right: float):
+        """Clamp the position of the sprite within a box.
+
+        It works the same as `clamp_position()`, but all the limits are required.
+        It saves the checks for `None`, as for clamping within the screen every frame.
+
+        Args:
+            up:
+                Up limit of the up side of the sprite.
+            left:
+                Left limit of the left side of the sprite.
+            down:
+                Down limit of the down side of the sprite.
+            right:
+                Right limit of the right side of the sprite.
+        """
+
+        x = self.x
+        if x > right - self.w:
+            x = right - self.w
+        if x < left:
+            x = left
+        self.x = x
+
+        y = self.y
+        if y > down - self.h:
+            y = down - self.h
+        if y < up:
+            y = up
+        self.y = y
+
     def clamp_velocity(
         self,
         vx_min: float = None,
@@ -355,10 +586,27 @@ class Sprite:
         if (vy_max is not None) and (self.vy > vy_max):
             self.vy = vy_max
 
+    @property
+    def killed(self) -> bool:
+        """If True, the sprite will be removed by the manager."""
+
+        return self._killed
+
+    @killed.setter
+    def killed(self, killed: bool):
+        # The manager only looks for killed sprites after it is told about one.
+        self._killed = killed
+        if killed and self.manager:
+            self.manager._any_killed = True
+
     def kill(self):
         """Kill the sprite, so it will be removed by the manager."""
 
-        self.killed = True
+        self._killed = True
+        # A pending delayed kill is no longer needed.
+        self._kill_frame = None
+        if self.manager:
+            self.manager._any_killed = True
 
     def kill_after_n_frames(self, num: int):
         """Kill the sprite in a delayed manner.
@@ -370,9 +618,13 @@ class Sprite:
                 setting 40 will kill the sprite after 2 seconds.
         """
 
-        self._frames_to_kill = num
+        if self.manager:
+            self.manager._schedule_kill(self, num)
+        else:
+            # Scheduled when the sprite is added to a manager.
+            self._frames_to_kill = num
 
-    def check_collision(self, other: Sprite) -> tuple[int, int]:
+    def check_collision(self, other: Sprite, _abs: callable = abs) -> tuple[int, int]:
         """Check collision with the other sprite.
 
         This is a simple example of collision detection.
@@ -386,48 +638,37 @@ class Sprite:
         Args:
             other:
                 The other sprite to check collision with.
+            _abs:
+                `abs` bound as a local for speed, not to be passed in.
 
         Returns:
             A 2-tuple or `None`.
         """
 
         if isinstance(other, Sprite) and (other is not self):
-            diff_x = (self.x + self.w / 2) - (other.x + other.w / 2)
-            diff_y = (self.y + self.h / 2) - (other.y + other.h / 2)
-            margin_dx = abs(diff_x) - ((self.w + other.w) / 2)
-            margin_dy = abs(diff_y) - ((self.h + other.h) / 2)
-
-            if margin_dx < 0 and margin_dy < 0:
-                # Collision happened.
-                abs_margin_dy = abs(margin_dy)
-                abs_margin_dx = abs(margin_dx)
-                is_at_top_or_bottom = abs_margin_dy <= abs_margin_dx
-                if diff_y >= 0:
-                    if diff_x >= 0:
-                        # `other` is top-left to `self`.
-                        if is_at_top_or_bottom:
-                            return (self.UP, abs_margin_dy)
-                        else:
-                            return (self.LEFT, abs_margin_dx)
-                    else:
-                        # `other` is top-right to `self`.
-                        if is_at_top_or_bottom:
-                            return (self.UP, abs_margin_dy)
-                        else:
-                            return (self.RIGHT, abs_margin_dx)
-                else:
-                    if diff_x >= 0:
-                        # `other` is bottom-left to `self`.
-                        if is_at_top_or_bottom:
-                            return (self.DOWN, abs_margin_dy)
-                        else:
-                            return (self.LEFT, abs_margin_dx)
-                    else:
-                        # `other` is bottom-right to `self`.
-                        if is_at_top_or_bottom:
-                            return (self.DOWN, abs_margin_dy)
-                        else:
-                            return (self.RIGHT, abs_margin_dx)
+            x = self.x
+            y = self.y
+            w = self.w
+            h = self.h
+            ox = other.x
+            oy = other.y
+            ow = other.w
+            oh = other.h
+            if not sprite_aabb_overlap(x, y, w, h, ox, oy, ow, oh):
+                return None
+
+            # Collision happened.
+            # Centres and margins are in doubled units to stay integer,
+            # only the returned depth is halved.
+            diff2_x = (x + x + w) - (ox + ox + ow)
+            diff2_y = (y + y + h) - (oy + oy + oh)
+            abs_margin2_dx = (w + ow) - _abs(diff2_x)
+            abs_margin2_dy = (h + oh) - _abs(diff2_y)
+            # `other` is above `self` when `diff2_y >= 0`,
+            # and to the left of `self` when `diff2_x >= 0`.
+            if abs_margin2_dy <= abs_margin2_dx:
+                return (self.UP if diff2_y >= 0 else self.DOWN, abs_margin2_dy / 2)
+            return (self.LEFT if diff2_x >= 0 else self.RIGHT, abs_margin2_dx / 2)
 
         return None
 
@@ -441,6 +682,12 @@ class Sprite:
         pass
 
 
+def _sprite_layer(sprite: Sprite) -> int:
+    """Get the layer of a sprite, the key to sort sprites by layer."""
+
+    return sprite._layer
+
+
 class Manager:
     """A class for app manager.
 
@@ -453,10 +700,18 @@ class Manager:
             The screen.
         sprite_list (list):
             The list holding all the available sprites.
-        target_fps (float):
+        target_fps (int):
             The target FPS.
+            Setting it also updates the frame budget in microseconds.
         actual_fps (float):
             The actual FPS.
+        gc_interval (int):
+            `30` by default, the number of frames between checks
+            for an extra garbage collection after a frame.
+        gc_low_watermark (int):
+            A quarter of the free memory at start by default.
+            The extra garbage collection is only done
+            when the free memory is below it.
         running (bool):
             The flag indicating the app is running or not.
 
@@ -472,22 +727,126 @@ class Manager:
         self.input_device = None
         self.screen = None
         self.sprite_list = []
+        self._sprites_by_cls = {}
+        self._sprite_classes = {}
+        self._any_killed = False
+        self._layers_dirty = False
+        self._kill_heap = []
+        self._kill_seq = 0
 
         self.target_fps = self.DEFAULT_TARGET_FPS
         self.actual_fps = 0
         self._frame_start_time = ticks_us()
+        self._frame_count = 0
+
+        # Let the runtime amortise garbage collections over allocations,
+        # and only collect opportunistically between frames on low memory.
+        gc.collect()
+        mem_free = gc.mem_free()
+        gc.threshold(mem_free // 4 + gc.mem_alloc())
+        self.gc_interval = 30
+        self.gc_low_watermark = mem_free // 4
 
         self.running = True
 
+    def _schedule_kill(self, sprite: Sprite, num: int):
+        """Schedule a sprite to be killed after a number of frames.
+
+        Args:
+            sprite:
+                The sprite to be killed.
+            num:
+                The number of frames after which the sprite will be killed.
+        """
+
+        deadline = self._frame_count + num
+        # A sprite rescheduled or killed early leaves a stale entry behind,
+        # which is recognised by its deadline and ignored.
+        # The stale entry keeps the sprite referenced until the deadline.
+        sprite._kill_frame = deadline
+        # The sequence number breaks ties so sprites are never compared.
+        self._kill_seq += 1
+        heappush(self._kill_heap, (deadline, self._kill_seq, sprite))
+
+    def _kill_due_sprites(self):
+        """Kill the sprites whose scheduled frame has come."""
+
+        kill_heap = self._kill_heap
+        frame_count = self._frame_count
+        while kill_heap and kill_heap[0][0] <= frame_count:
+            deadline, _, sprite = heappop(kill_heap)
+            if sprite._kill_frame == deadline:
+                sprite.kill()
+
     def _remove_killed_sprites(self):
-        """Remove all the killed sprites from the manager."""
+        """Remove all the killed sprites from the manager.
+
+        Nothing is done unless a sprite has been killed since the last call.
+        """
+
+        if not self._any_killed:
+            return
+
+        self._any_killed = False
+        self._drop_killed(self.sprite_list)
+        for sprites in self._sprites_by_cls.values():
+            self._drop_killed(sprites)
+
+    @micropython.native
+    def _drop_killed(self, sprites: list[Sprite, ...]):
+        """Remove the killed sprites from a list in place.
 
-        self.sprite_list = [sprite for sprite in self.sprite_list if not sprite.killed]
+        The sprites left are moved to the front in their order,
+        and the tail is deleted, so no new list is made.
+
+        Args:
+            sprites:
+                The list of sprites to compact.
+        """
+
+        n = 0
+        for sprite in sprites:
+            if not sprite._killed:
+                sprites[n] = sprite
+                n += 1
+        del sprites[n:]
+
+    def _get_sprite_classes(self, cls: type) -> list[type, ...]:
+        """Get the class and all its base classes except `object`.
+
+        The result is cached for each class.
+
+        Args:
+            cls:
+                The class of a sprite.
+
+        Returns:
+            A list of the class and all its base classes.
+        """
+
+        classes = self._sprite_classes.get(cls)
+        if classes is None:
+            classes = [cls]
+            for base in cls.__bases__:
+                if base is not object:
+                    for c in self._get_sprite_classes(base):
+                        if c not in classes:
+                            classes.append(c)
+            self._sprite_classes[cls] = classes
+        return classes
 
     def _sort_sprites_by_layer(self):
-        """Sort all the sprites added to the manager by their layer."""
+        """Sort all the sprites added to the manager by their layer.
 
-        self.sprite_list.sort(key=lambda x: x.get_layer())
+        Nothing is done unless a sprite has been added below the last one
+        or has changed its layer since the last call.
+        """
+
+        if not self._layers_dirty:
+            return
+
+        self._layers_dirty = False
+        self.sprite_list.sort(key=_sprite_layer)
 
     def _frame_routine(self):
         """Frame routine.
@@ -496,24 +855,41 @@ class Manager:
         In turn it calls the frame routines of all the components added to the manager.
         """
 
+        # Hot attributes are bound to locals to save lookups in the loops.
+        # The sprite list is only ever modified in place.
+        input_device = self.input_device
+        sprite_list = self.sprite_list
+        screen = self.screen
+        frame_count = self._frame_count + 1
+        self._frame_count = frame_count
+
         # Input device frame routine.
-        if self.input_device:
-            self.input_device.update()
+        if input_device:
+            input_device.update()
 
         # Sprites frame routines.
-        for sprite in self.sprite_list:
+        if self._kill_heap:
+            self._kill_due_sprites()
+        for sprite in sprite_list:
             sprite._frame_routine()
 
         self.update()
         self._remove_killed_sprites()
+        self._sort_sprites_by_layer()
 
         # Screen frame routine.
-        if self.screen:
-            for sprite in self.sprite_list:
-                self.screen.blit(sprite)
-            self.screen.flip()
-
-        gc.collect()
+        if screen:
+            screen._begin_frame()
+            blit = screen.blit
+            for sprite in sprite_list:
+                blit(sprite)
+            screen.flip()
+
+        if (
+            frame_count % self.gc_interval == 0
+            and gc.mem_free() < self.gc_low_watermark
+        ):
+            gc.collect()
 
     def _frame_tick(self) -> bool:
         """Frame tick.
@@ -527,12 +903,65 @@ class Manager:
 
         end_time = ticks_us()
         duration = ticks_diff(end_time, self._frame_start_time)
-        if duration >= US_PER_S / self.target_fps:
+        if duration >= self._frame_budget_us:
             self.actual_fps = US_PER_S / duration
             self._frame_start_time = end_time
             return True
         return False
 
+    def _frame_remaining_us(self) -> int:
+        """Get the remaining time of the current frame.
+
+        Returns:
+            The remaining time of the current frame in microseconds.
+            It is negative when the frame budget is overrun.
+        """
+
+        return self._frame_budget_us - ticks_diff(ticks_us(), self._frame_start_time)
+
+    async def _input_loop(self):
+        """Input loop.
+
+        It calls `poll()` of the input device every `poll_ms` milliseconds.
+        """
+
+        input_device = self.input_device
+        while self.running:
+            input_device.poll()
+            await asyncio.sleep_ms(input_device.poll_ms)
+
+    async def _render_loop(self):
+        """Render loop.
+
+        It calls the frame routine at the target FPS.
+        """
+
+        while self.running:
+            await asyncio.sleep(0)
+            # Manager frame routine.
+            self._frame_routine()
+
+            # Sleep through the remaining whole milliseconds of the frame,
+            # so that other tasks can run in the meantime.
+            remaining_ms = self._frame_remaining_us() // US_PER_MS
+            if remaining_ms > 0:
+                await asyncio.sleep_ms(remaining_ms)
+
+            # Try to achieve the target FPS.
+            while not self._frame_tick():
+                await asyncio.sleep(0)
+
+    @property
+    def target_fps(self) -> int:
+        """The target FPS."""
+
+        return self._target_fps
+
+    @target_fps.setter
+    def target_fps(self, fps: int):
+        self._target_fps = fps
+        self._frame_budget_us = US_PER_S // fps
+
     def add_sprite(self, sprite: Sprite):
         """Add a sprite to the manager.
 
@@ -541,11 +970,29 @@ class Manager:
                 The sprite to be added to the manager.
         """
 
-        self.sprite_list.append(sprite)
-        self._sort_sprites_by_layer()
+        sprite_list = self.sprite_list
+        # Appending keeps the list sorted unless the sprite is below the last one.
+        # Sprites sharing a layer have no guaranteed order between them,
+        # as the sort of MicroPython is not stable.
+        if sprite_list and sprite._layer < sprite_list[-1]._layer:
+            self._layers_dirty = True
+        sprite_list.append(sprite)
+        for cls in self._get_sprite_classes(type(sprite)):
+            self._sprites_by_cls.setdefault(cls, []).append(sprite)
         sprite.manager = self
-
-    def get_sprites(self, cls: type = Sprite, name: str = None) -> list[Sprite, ...]:
+        if sprite._killed:
+            self._any_killed = True
+        frames_to_kill = sprite._frames_to_kill
+        if frames_to_kill is not None:
+            sprite._frames_to_kill = None
+            self._schedule_kill(sprite, frames_to_kill)
+
+    def get_sprites(
+        self,
+        cls: type = Sprite,
+        name: str = None,
+        exact: bool = False,
+    ) -> list[Sprite, ...]:
         """Get a filtered list of sprites.
 
         Args:
@@ -553,18 +1000,67 @@ class Manager:
                 The class of the sprites that should be returned.
             name:
                 The name of the sprites that should be returned.
+            exact:
+                If True, instances of subclasses of `cls` are not returned.
 
         Returns:
-            A list of selected sprites.
+            A new list of selected sprites in the order they were added.
         """
 
-        return [
-            sprite
-            for sprite in self.sprite_list
-            if isinstance(sprite, cls) and ((not name) or (sprite.name == name))
-        ]
+        # The class bucket saves scanning all the sprites,
+        # it is kept by the manager so a copy is returned.
+        sprites = self._sprites_by_cls.get(cls)
+        if sprites is None:
+            return []
+        if name or exact:
+            return [
+                sprite
+                for sprite in sprites
+                if ((not exact) or (type(sprite) is cls))
+                and ((not name) or (sprite.name == name))
+            ]
+        return list(sprites)
+
+    @micropython.native
+    def get_colliding_sprites(
+        self,
+        sprite: Sprite,
+        cls: type = Sprite,
+    ) -> list[Sprite, ...]:
+        """Get the sprites whose bounding boxes overlap a sprite.
+
+        It only looks at the sprites of `cls`, and it is a cheap test
+        without any information of where the overlap happened.
+        Use `Sprite.check_collision()` on the results for that.
 
-    def kill_sprites(self, cls: type = Sprite, name: str = None):
+        Args:
+            sprite:
+                The sprite to check against.
+            cls:
+                The class of the sprites to check.
+
+        Returns:
+            A new list of the overlapping sprites in the order they were added,
+            not including `sprite` itself and killed sprites.
+        """
+
+        x = sprite.x
+        y = sprite.y
+        right = x + sprite.w
+        bottom = y + sprite.h
+        colliding = []
+        for other in self._sprites_by_cls.get(cls, ()):
+            if other is sprite or other._killed:
+                continue
+            # The x axis is tested first, the y attributes are only read if it passes.
+            ox = other.x
+            if x < ox + other.w and right > ox:
+                oy = other.y
+                if y < oy + other.h and bottom > oy:
+                    colliding.append(other)
+        return colliding
+
+    def kill_sprites(self, cls: type = Sprite, name: str = None, exact: bool = False):
         """Kill a filtered list of sprites.
 
         Args:
@@ -572,10 +1068,19 @@ class Manager:
                 The class of the sprites that should be killed.
             name:
                 The name of the sprites that should be killed.
+            exact:
+                If True, instances of subclasses of `cls` are not killed.
         """
 
-        for sprite in self.sprite_list:
-            if isinstance(sprite, cls) and ((not name) or (sprite.name == name)):
+        # Killing does not remove sprites from the lists until the frame ends,
+        # so the class bucket can be walked directly.
+        sprites = self._sprites_by_cls.get(cls)
+        if sprites is None:
+            return
+        for sprite in sprites:
+            if ((not exact) or (type(sprite) is cls)) and (
+                (not name) or (sprite.name == name)
+            ):
                 sprite.kill()
 
     def exit(self):
@@ -593,24 +1098,30 @@ class Manager:
             # Manager frame routine.
             self._frame_routine()
 
+            # Sleep through most of the remaining frame time,
+            # then poll for the last few hundred microseconds.
+            remaining = self._frame_remaining_us()
+            if remaining > SLEEP_THRESHOLD_US:
+                sleep_us(remaining - SLEEP_MARGIN_US)
+
             # Try to achieve the target FPS.
             while not self._frame_tick():
                 pass
 
     async def arun(self):
-        """Run the app asynchronously with `uasyncio`."""
+        """Run the app asynchronously with `uasyncio`.
+
+        If `poll_ms` of the input device is greater than `0`,
+        the input device is polled in a separate task.
+        """
 
         if self.screen:
             self.screen.clear()
 
-        while self.running:
-            await asyncio.sleep(0)
-            # Manager frame routine.
-            self._frame_routine()
-
-            # Try to achieve the target FPS.
-            while not self._frame_tick():
-                await asyncio.sleep(0)
+        if self.input_device and self.input_device.poll_ms > 0:
+            await asyncio.gather(self._input_loop(), self._render_loop())
+        else:
+            await self._render_loop()
 
     def update(self):
         """This method may implement the logic of the manager.